@@ -29,13 +29,19 @@ import shutil
 import sys
 import re
 import hashlib
+import time
 from datetime import datetime
 
-import markdown
-from jinja2 import Template,Environment,FileSystemLoader
-import yaml
-
 from micropress.util import *
+from micropress import util
+from micropress.fs import snapshot
+from micropress.manifest import BuildManifest, hash_values
+from micropress.deps import DependencyRecorder, template_closure
+from micropress.cache import ContentCache, DiskCache, LRU
+from micropress.index import PageIndex
+from micropress.compress import compress_outputs
+from micropress.profiling import span
+from micropress import deploy
 
 # constants
 SITE_CONFIG_PATH = 'site.yaml'
@@ -44,6 +50,20 @@ RESOURCES_DIR = 'resources'
 PAGES_DIR = 'pages'
 DEFAULT_OUTPUT_DIR = 'site'
 DEFAULT_PREVIEW_DIR = '.preview'
+CACHE_DIR = '.micropress'
+MANIFEST_PATH = os.path.join(CACHE_DIR,'manifest')
+CONTENT_CACHE_DIR = os.path.join(CACHE_DIR,'content')
+COMPILE_CACHE_DIR = os.path.join(CACHE_DIR,'compiled')
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_DIR,'templates')
+CHANGES_PATH = os.path.join(CACHE_DIR,'changes.json')
+
+def clean():
+  "Remove the output and preview directories"
+  if os.path.exists(DEFAULT_OUTPUT_DIR):
+    shutil.rmtree(DEFAULT_OUTPUT_DIR)
+  if os.path.exists(DEFAULT_PREVIEW_DIR):
+    shutil.rmtree(DEFAULT_PREVIEW_DIR)
+  snapshot.invalidate()
 
 # TODO: template functions! - what do we need here?
 
@@ -56,15 +76,32 @@ class Processor():
   resource_from_path/path_from_resource
   
   abc/foo.css -> abc/foo.css
+  
+  Files are published with the publish strategy (see util.publish),
+  which defaults to the site's 'publish' setting.
+  
+  Output of processors which define a cachekey() is stored in cache
+  (a DiskCache assigned by the Site) and reused when the same source
+  is built again, for example after a clean or into another directory
   """
-  def __init__(self,indir,ext=None):
+  def __init__(self,indir,ext=None,publish=None):
     self.indir = indir
     self.ext = ext
-    
-  def resources(self):
-    """enumeration of all resources that this processor publishes"""
+    self.publish = publish
+    self.cache = None
+    self._resources = None
+    self._dirstamps = None
+
+  def _scan(self):
+    """
+    Walk the input directory returning the list of resources and
+    the mtime of every directory walked
+    """
+    resources = []
+    dirstamps = {self.indir:None}
     # TODO: implement a common list of exclusions
-    for root, dirs, files in os.walk(self.indir):
+    for root, dirs, files in snapshot.walk(self.indir):
+      dirstamps[root] = snapshot.getmtime(root)
       # do not walk directories with dot prefix
       dirs[:] = [d for d in dirs if d[0] != '.']
       for f in files:
@@ -75,7 +112,31 @@ class Processor():
             continue
         if f[0] == '.': # skip invisible
           continue
-        yield self.resource_from_path(os.path.join(root,f))
+        resources.append(self.resource_from_path(os.path.join(root,f)))
+    return (resources,dirstamps)
+
+  def refresh(self):
+    """
+    Rescan the input directory if a file has been added or removed
+    since the last scan. Only directory mtimes are checked to detect
+    this. Returns True if the resources were rescanned
+    """
+    if self._dirstamps is not None:
+      for (dir,mtime) in self._dirstamps.items():
+        current = snapshot.getmtime(dir) if snapshot.isdir(dir) else None
+        if current != mtime:
+          break
+      else:
+        return False
+    (self._resources,self._dirstamps) = self._scan()
+    self._resourceset = set(self._resources)
+    return True
+    
+  def resources(self):
+    """enumeration of all resources that this processor publishes"""
+    if self._resources is None:
+      self.refresh()
+    return list(self._resources)
   
   def resource_from_path(self,path):
     """converts this internal source path into an output resource"""
@@ -85,31 +146,85 @@ class Processor():
     """converts this resource into the source path"""
     return rsc
     
+  def dependencies(self,src):
+    """
+    Files the output built from src depends upon. Subclasses whose
+    sources include other files should add them
+    """
+    return [src]
+
+  def cachekey(self,src):
+    """
+    Key identifying the output built from src, which must cover the
+    contents of its dependencies, the tool and the options used.
+    None (the default) if the output should not be cached
+    """
+    return None
+    
   def accept(self,rsc):
     """determine if the processor can handle this resource"""
-    # TODO this could be done better
-    return rsc in self.resources()
+    if self._resources is None:
+      self.refresh()
+    return rsc in self._resourceset
     
   def _dobuild(self,src,dest):
     """
     Perform the build on a source file with a target destination. By
-    default simply performs a copy of the source file. Subclasses may
-    override to implement processing of some kind
+    default simply publishes (copies or links) the source file.
+    Subclasses may override to implement processing of some kind
     """
-    shutil.copyfile(src,dest)
+    publish(src,dest,self.publish)
+    
+  def _dobuildall(self,builds):
+    """
+    Perform the build of a list of (source,destination) pairs. By
+    default calls _dobuild for each pair. Subclasses may override
+    to build many files at once
+    """
+    for (src,dest) in builds:
+      self._dobuild(src,dest)
     
   def build(self,rsc,outdir):
     """create the specified resource in the output directory"""
-    dest = os.path.join(outdir,rsc)
-    dirname = os.path.dirname(dest)
-    mkdir(dirname)
-    src = self.path_from_resource(rsc)
-    if not isuptodate(dest,src):
-      # root include resources - needs to
-      info("copying to %s " % dest)
-      self._dobuild(src,dest)
-    else:
-      debug("skipping %s" % dest)
+    self.buildall([rsc],outdir)
+
+  def buildall(self,rscs,outdir):
+    """create a number of resources in the output directory"""
+    builds = []
+    for rsc in rscs:
+      dest = os.path.join(outdir,rsc)
+      dirname = os.path.dirname(dest)
+      mkdir(dirname)
+      src = self.path_from_resource(rsc)
+      if not isuptodate(dest,*self.dependencies(src)):
+        # root include resources - needs to
+        info("copying to %s " % dest)
+        builds.append((src,dest))
+      else:
+        debug("skipping %s" % dest)
+    if self.cache is None:
+      if builds:
+        self._dobuildall(builds)
+      return
+    keys = {}
+    uncached = []
+    for (src,dest) in builds:
+      key = keys[dest] = self.cachekey(src)
+      data = self.cache.get(key) if key else None
+      if data is None:
+        uncached.append((src,dest))
+      else:
+        debug("%s from cache" % dest)
+        f = open(dest,'wb')
+        try:
+          f.write(data)
+        finally:
+          f.close()
+    if uncached:
+      self._dobuildall(uncached)
+      for (src,dest) in uncached:
+        if keys[dest]:
+          self.cache.put(keys[dest],open(dest,'rb').read())
 
       
 class StaticResourcesProcessor(Processor):
@@ -129,13 +244,50 @@ class StaticResourcesProcessor(Processor):
   def path_from_resource(self,rsc):
     return os.path.join(self.indir,rsc)
     
-class ResourceFactory():
+class Publisher():
   """
-  Processor which creates a single resource by name
+  Mixin for processors whose resources are computed from the site
+  rather than scanned from a directory
   """
+  _published = None
+
+  def refresh(self):
+    "True if the published resources changed since the last refresh"
+    published = self.resources()
+    changed = published != self._published
+    self._published = published
+    return changed
+
+  def others(self):
+    """
+    The site's other processors, in order. Used rather than the site's
+    resource index, which includes (and is built from) our resources
+    """
+    return [proc for proc in self.site.processors if proc is not self]
+
+  def publisher(self,rsc):
+    "The first of the site's other processors which publishes rsc or None"
+    for proc in self.others():
+      if proc.accept(rsc):
+        return proc
+    return None
+
+class ResourceFactory(Publisher):
+  """
+  Processor which creates a single resource by name. Such resources
+  are rebuilt by every brew unless the processor defines values(rsc),
+  returning the values (other than files) a resource is built from,
+  in which case it is rebuilt only when those change. inputs(rsc) may
+  also return the files (such as templates) it is built from. If
+  recorded is True, files and values used while a resource is built
+  (see micropress.deps) are recorded as for pages
+  """
+  recorded = False
+
   def __init__(self,site,name):
     self.site = site
     self.name = name
+    self._memo = {}
 
   def resources(self):
     return [self.name]
@@ -143,6 +295,18 @@ class ResourceFactory():
   def accept(self,rsc):
     return rsc == self.name
 
+  def per_brew(self,name,compute):
+    """
+    Result of compute(), computed once per brew and held under name.
+    Recomputed on every call outside of a brew
+    """
+    site = self.site
+    generation = (site.generation,site.manifest)
+    memo = self._memo.get(name)
+    if memo is None or memo[0] != generation or site.manifest is None:
+      memo = self._memo[name] = (generation,compute())
+    return memo[1]
+
   def _dobuild(dest):
     "Subclasses must implement this method"
     pass
@@ -167,6 +331,25 @@ class Site():
     domain - URL where site will ultimately be deployed from config
     root - path name for where site is deployed (default /)
     hooks - List of function that will be invoked with specified hooks
+    bodies - LRU of the bodies of pages, read when first needed
+    preview_mode - True when served by the preview server
+    watching - True if a watcher keeps the site current through sync(),
+      in which case preview mode does not check pages for changes
+    generation - incremented whenever the site is refreshed or synced
+    pages - dictionary of pages by name
+    index - PageIndex over pages
+    resource_collisions - list of (resource, processor, processor) for
+      resources published by more than one processor
+    resource_aliases - functions mapping a resource name to the name it
+      is published under (or None), used by resource_href
+    manifest - BuildManifest of the current brew (None outside of brew)
+    changes - outputs added, modified and deleted by the last brew (see
+      micropress.deploy)
+    values - named values other than files (such as digests of remote
+      data) that pages may depend upon, set by extensions before pages
+      are made. A page depends on those recorded by the recorder while
+      it renders
+    explain - names of pages for which to print why they are (re)built
     
   Hook events:
     load
@@ -175,26 +358,88 @@ class Site():
   """
   
   def __init__(self,path):
+    # forget files stat'ed for any site loaded before
+    snapshot.invalidate()
     self.hooks = []
     self._loaded_ext = []
     self.ext = {}
     self.pages = {}
+    self.index = PageIndex()
     self.path = path
     self.markdown_opts = {}
+    self.bodies = LRU(1000)
+    # strings repeated across pages (tags, header names), shared
+    self._strings = {}
     self.config = {}
     self.preview_mode = False
+    self.watching = False
+    self.generation = 0
     self.page_decorators = []
+    self.manifest = None
+    self.changes = None
+    self.shard = None
+    self.costs = {}
+    self.values = {}
+    self.buildkey = None
+    self.pagesig = None
+    self.recorder = None
+    self.explain = set()
+    self._template_files = None
+    self._template_deps = {}
+    self._template_stamps = None
+    self._resource_index = None
+    self._indexed_processors = None
+    self.resource_collisions = []
+    self.resource_aliases = []
     self.processors = [
       StaticResourcesProcessor("resources"),
       Processor("css",".css"),
       Processor("js",".js")      
     ]
     # extension should be able to add to templates too!
-    self.load()
-    self.env = Environment(loader=FileSystemLoader(os.getcwd()+'/templates'))
-    self.loadpages()
+    with span('load'):
+      self.load()
+    with span('loadpages'):
+      self.loadpages()
     self._fire_hook('load')
     
+  def __getattr__(self,name):
+    """
+    The markdown converter (markdown) and jinja2 environment (env) are
+    created when first used, so that commands which do not render
+    pages need not import markdown or jinja2
+    """
+    if name == 'markdown':
+      import markdown
+      self.markdown = markdown.Markdown(**(self.config.get('markdown',{})))
+      return self.markdown
+    if name == 'env':
+      self.env = self._environment()
+      return self.env
+    raise AttributeError(name)
+
+  def _environment(self):
+    """
+    jinja2 environment for the templates directory. Compiled templates
+    are cached on disk (in template-cache) for other processes. Only
+    in preview mode are templates checked for changes on each use
+    """
+    from jinja2 import Environment,FileSystemLoader,FileSystemBytecodeCache
+    cachedir = self.config.get('template-cache',TEMPLATE_CACHE_DIR)
+    bcc = None
+    if cachedir:
+      mkdir(cachedir)
+      bcc = FileSystemBytecodeCache(cachedir)
+    return Environment(loader=FileSystemLoader(os.getcwd()+'/templates'),
+      bytecode_cache=bcc,auto_reload=self.preview_mode)
+
+  def precompile(self):
+    "Compile every template into the template cache. Returns their names"
+    names = [t for t in listfiles(TEMPLATE_DIR) if t.endswith('.tmpl')]
+    for name in names:
+      self.env.get_template(name)
+    return names
+
   # TODO: we need to be really clear here about absolute/relative links
   # URL might be a good term to use
   def url(self):
@@ -205,13 +450,55 @@ class Site():
 
   def resource_href(self,rsc):
     "Lookup a resource by name, and returns the path to that resource"
-    for proc in self.processors:
-       if proc.accept(rsc):
-         return self.root+rsc
+    for alias in self.resource_aliases:
+      rsc = alias(rsc) or rsc
+    if self.resource_processor(rsc):
+      return self.root+rsc
     raise Exception("No resource %s found" %rsc)  
+
+  def resource_index(self):
+    """
+    Mapping of resource name to the processor which publishes it. Built
+    by a single scan of all processors. If several processors publish
+    the same resource (for example css/foo.css and css/foo.less) the
+    first processor wins and the collision is recorded
+    """
+    if self._resource_index is None:
+      index = {}
+      collisions = []
+      for proc in self.processors:
+        for rsc in proc.resources():
+          if rsc in index:
+            info("warning: %s is published by both %s and %s" %
+              (rsc,index[rsc].__class__.__name__,proc.__class__.__name__))
+            collisions.append((rsc,index[rsc],proc))
+          else:
+            index[rsc] = proc
+      self._resource_index = index
+      self._indexed_processors = list(self.processors)
+      self.resource_collisions = collisions
+    return self._resource_index
+
+  def resource_processor(self,rsc):
+    "The processor publishing a resource or None"
+    return self.resource_index().get(rsc)
+
+  def refresh_resources(self):
+    """
+    Rescan processors whose directories changed, invalidating the
+    resource index if anything changed
+    """
+    changed = False
+    for proc in self.processors:
+      if hasattr(proc,'refresh') and proc.refresh():
+        changed = True
+    if changed or self._indexed_processors != self.processors:
+      self._resource_index = None
     
   def getcontents(self,file):
     "read the contents of a file. Useful for template includes"
+    if self.recorder is not None:
+      self.recorder.files.add(file)
     f = codecs.open(file, mode="r",encoding=self.encoding)
     return f.read()
     
@@ -226,30 +513,68 @@ class Site():
     if module not in self._loaded_ext:
       # http://docs.python.org/library/functions.html#__import__
       # If you simply want to import a module (potentially within a package) by name, you can call __import__() and then look it up in sys.modules:
-      __import__(module)
-      ext = sys.modules[module]
-      ext.extend_micropress(self)
+      with span(module,'extension'):
+        __import__(module)
+        ext = sys.modules[module]
+        ext.extend_micropress(self)
       self._loaded_ext.append(module)
   
   def load_template(self,name):
-    return self.env.get_template(name+".tmpl")
+    env = self.env
+    # preview mode may have been entered since env was created
+    env.auto_reload = self.preview_mode
+    return env.get_template(name+".tmpl")
+
+  def template_files(self):
+    "Paths of all files in the templates directory"
+    if self._template_files is None:
+      self._template_files = [os.path.join(TEMPLATE_DIR,t)
+        for t in listfiles(TEMPLATE_DIR)]
+    return self._template_files
+
+  def template_dependencies(self,name):
+    """
+    Files of the named template and every template it extends,
+    includes or imports. If that cannot be determined statically
+    all templates are returned
+    """
+    if name not in self._template_deps:
+      files = template_closure(self.env,name+".tmpl",TEMPLATE_DIR)
+      if files is None:
+        files = self.template_files()
+      self._template_deps[name] = files
+    return self._template_deps[name]
 
   def _fire_hook(self,event):
     "Invoke all hooks with the specified event"
     for h in self.hooks:
-      h(self,event)
+      with span("%s %s" % (getattr(h,'__name__',h),event),'hook'):
+        h(self,event)
 
   def load(self):
     """Load options from config file"""
+    import yaml
     self.config = yaml.load(open(self.path))
     for ext in self.config.get('extensions',[]):
       self.load_extension(ext)
     self.encoding = self.config.get('encoding','utf8')
     self.domain = self.config.get('domain')
     self.root = self.config.get('root','/')
-    self.markdown = markdown.Markdown(**(self.config.get('markdown',{})))
+    # recreated with the new configuration when next used
+    self.__dict__.pop('markdown',None)
+    util.tool_timeouts.update(self.config.get('tool-timeouts',{}))
+    util.tool_jobs = self.config.get('tool-jobs')
+    util.publish_strategy = self.config.get('publish','auto')
+    self.bodies.maxitems = self.config.get('page-bodies',1000)
+    self.content_cache = ContentCache(self,CONTENT_CACHE_DIR,
+      maxsize=self.config.get('content-cache-size',64*2**20))
+    self.compile_cache = DiskCache(
+      self.config.get('compile-cache',COMPILE_CACHE_DIR))
+    for p in self.processors:
+      if isinstance(p,Processor):
+        p.cache = self.compile_cache
     # alright we're loaded
-    self.loadts = os.path.getmtime(self.path)
+    self.loadts = snapshot.getmtime(self.path)
   
   def loadpages(self):
     """Scan pages directory for new pages"""
@@ -267,77 +592,320 @@ class Site():
            for decorators in self.page_decorators:
             decorators.extend_page()
            newpages[rest] = p
+           self.index.add(p)
+    for name in self.pages:
+      if name not in newpages:
+        self.index.remove(self.pages[name].name)
     self.pages = newpages
   
   def page(self,path):
     "Return a page by name. Returns None if no such page exists"
+    if self.recorder is not None:
+      self.recorder.pages = True
     p = self.pages.get(path)
-    if p and self.preview_mode:
+    if p and self.preview_mode and not self.watching:
       p.refresh()
     return p
     
   # this is inspired by the wordpress loop!
   # http://codex.wordpress.org/Template_Tags/get_posts
   # TODO: is tag/category really necessary? ... hmmmm
-  def querypages(self,tag=None,category=None,maxitems=None,order=None):
+  def querypages(self,tag=None,category=None,maxitems=None,order=None,
+    offset=0,tags=None):
     """
     Return a list of defined pages, optionally filter by particular
     attributes and/or sorted in some particular way
+    
+    tag - only pages with this tag
+    tags - only pages with all of these tags
+    category - only pages in this category
+    order - None, 'date_created', 'date_modified' or 'title'
+    offset - skip this many pages, for pagination
+    maxitems - return at most this many pages
     """
+    if self.recorder is not None:
+      self.recorder.pages = True
     
-    if self.preview_mode:
+    if self.preview_mode and not self.watching:
       for p in self.pages.values():
         p.refresh()
     
-    pages = []
-    for p in self.pages.values():
-      if tag is not None and tag not in p.tags:
-        continue
-      if category is not None and category != p.category:
-        continue  
-      pages.append(p)
-    if order:
-      if order == 'date_created':
-        pages.sort(key=lambda p:p.date_created())
-        pages.reverse()
-      elif order == 'date_modified':
-        pages.sort(key=lambda p:p.date_modified())
-        pages.reverse()
-      elif order == 'title':
-        pages.sort(key=lambda p:p.title)
-    
-    if maxitems is not None:
-      pages = pages[0:maxitems]
-    return pages
+    tags = list(tags or [])
+    if tag is not None:
+      tags.append(tag)
+    return self.index.query(tags,category,order,offset,maxitems)
   
   def refresh(self):
     """Reload configuration if needed"""
-    if os.path.getmtime(self.path) != self.loadts:
+    self.generation += 1
+    snapshot.invalidate()
+    if snapshot.getmtime(self.path) != self.loadts:
       self.load()
     self.loadpages()
+    self.refresh_resources()
+    self._fire_hook('load')
+
+  def sync(self,paths):
+    """
+    Bring the site up to date with a set of changed paths, as reported
+    by a watcher (see micropress.watch). Only what changed is re-read
+    """
+    paths = set(os.path.normpath(p) for p in paths)
+    self.generation += 1
+    for path in paths:
+      snapshot.forget(path)
+    if self.path in paths and snapshot.getmtime(self.path) != self.loadts:
+      self.load()
+    prefix = PAGES_DIR+os.sep
+    for path in paths:
+      if path.startswith(prefix):
+        # directory listings of added/removed pages were forgotten above
+        self.loadpages()
+        break
+    for path in paths:
+      if path.startswith(prefix):
+        p = self.pages.get(os.path.splitext(path[len(prefix):])[0])
+        if p and snapshot.exists(p.path):
+          p.refresh()
+    self.refresh_resources()
     self._fire_hook('load')
   
-  def brew(self,outputdir):
-    "Create the site in the specified output directory"
+  def brew(self,outputdir,jobs=1,shard=None):
+    """
+    Create the site in the specified output directory. If jobs > 1
+    resources and pages are built by a pool of worker processes. If
+    shard is given as (i,n) only the i-th of n shares of the site is
+    built (see micropress.shard)
+    
+    Files are stat'ed afresh by every brew, but pages and configuration
+    are those loaded with the site, so a long lived site should be
+    refresh()ed before brewing
+    """
     
+    self.shard = shard
+    try:
+      (before,syscalls) = self._begin_brew(outputdir)
+      if jobs > 1:
+        from micropress.parallel import parallel_brew
+        parallel_brew(self,outputdir,jobs)
+      else:
+        (resources,pages) = self.brewing()
+        with span('resources'):
+          self._build_batches(resources,outputdir)
+        # make pages
+        with span('pages'):
+          for p in pages:
+            p.make(outputdir)
+      self._finish_brew(outputdir,before,syscalls,jobs)
+    finally:
+      self.shard = None
+      self.manifest = None
+
+  def merge(self,outputdir,sharddirs,jobs=1):
+    """
+    Combine the outputs of shards brewed into sharddirs into outputdir,
+    then build the site-wide resources once (see micropress.shard)
+    """
+    from micropress import shard
+    try:
+      (before,syscalls) = self._begin_brew(outputdir)
+      with span('merge'):
+        shard.merge(self,outputdir,sharddirs)
+      resources = [(rsc,p) for (rsc,p) in self.publishing()
+        if isinstance(p,ResourceFactory)]
+      with span('resources'):
+        self._build_batches(resources,outputdir)
+      self._finish_brew(outputdir,before,syscalls,jobs)
+    finally:
+      self.manifest = None
+
+  def _begin_brew(self,outputdir):
+    """
+    Prepare a brew into outputdir, returning the outputs recorded
+    before it and the filesystem call count
+    """
+    snapshot.invalidate()
+    syscalls = snapshot.syscalls
+    # loaded first so that pre-brew hooks can consult it
+    self.manifest = BuildManifest(MANIFEST_PATH)
+    self.costs = {}
+    for k in publish_stats:
+      publish_stats[k] = 0
+    before = self.manifest.outputs(outputdir)
     self._fire_hook('pre-brew')
     # create output dir if it doesn't exist
     mkdir(outputdir)
+    self._template_files = None
+    self._template_deps = {}
+    stamps = [filestamp(t) for t in self.template_files()]
+    if stamps != self._template_stamps:
+      # templates are not checked for changes when used outside preview
+      self.__dict__.pop('env',None)
+      self._template_stamps = stamps
+    self.buildkey = hash_values(__version__,self.config,
+      self.domain,self.root,self.preview_mode)
+    # pages which list other pages are rebuilt when any header changes
+    self.pagesig = hash_values(
+      sorted((p.name,p.header) for p in self.pages.values()))
 
-    for p in self.processors:
-        for rsc in p.resources():
-          p.build(rsc,outputdir)
+    with span('refresh resources'):
+      self.refresh_resources()
+    return (before,syscalls)
 
-    # make pages
-    for p in self.querypages():
-      p.make(outputdir)
+  def _finish_brew(self,outputdir,before,syscalls,jobs):
+    "Compress, record and report the outputs of a brew"
+    outputs = self.outputs(outputdir)
+    with span('compress'):
+      # a serial brew still compresses on a thread per cpu
+      threads = jobs if jobs > 1 else None
+      outputs.update(compress_outputs(self,outputdir,threads,outputs))
+    self.changes = deploy.changes(self.manifest,outputdir,before,outputs)
+    deploy.save(self.changes,CHANGES_PATH)
+    self.manifest.save()
+    from micropress import shard
+    if self.shard:
+      shard.write_record(self,outputdir,self.shard,outputs)
+    else:
+      # shards must all see the same costs, so only whole brews save them
+      prefix = os.path.join(outputdir,'')
+      costs = shard.load_costs()
+      costs.update(self.costs)
+      shard.save_costs(dict((rel,cost) for (rel,cost) in costs.items()
+        if prefix+rel in outputs))
+    if publish_stats['copied'] or publish_stats['linked']:
+      info("published %i bytes copied, %i bytes linked" %
+        (publish_stats['copied'],publish_stats['linked']))
+    if self.content_cache.disk.written or jobs > 1:
+      self.content_cache.disk.evict()
+    debug("%i filesystem calls" % (snapshot.syscalls-syscalls))
     self._fire_hook('post-brew')
+
+  def _build_batches(self,resources,outputdir):
+    "Build (resource,processor) pairs, consecutive ones of a processor together"
+    batches = []
+    for (rsc,p) in resources:
+      if batches and batches[-1][0] is p:
+        batches[-1][1].append(rsc)
+      else:
+        batches.append((p,[rsc]))
+    for (p,rscs) in batches:
+      self.build_resources(p,rscs,outputdir)
+
+  def outputs(self,outputdir):
+    "Set of the files the site (or shard being brewed) publishes in outputdir"
+    (resources,pages) = self.brewing()
+    outputs = set(os.path.join(outputdir,rsc) for (rsc,p) in resources)
+    outputs.update(os.path.join(outputdir,p.name+'.html') for p in pages)
+    return outputs
+
+  def brewing(self):
+    """
+    (resources,pages) built by a brew, as lists of (resource,processor)
+    and of pages. Only the share of the shard if brewing a shard
+    """
+    resources = self.publishing()
+    pages = self.querypages()
+    if self.shard is None:
+      return (resources,pages)
+    from micropress import shard
+    return shard.share(self,resources,pages,self.shard)
+
+  def publishing(self):
+    "List of (resource,processor) for every resource of the site"
+    index = self.resource_index()
+    return [(rsc,proc) for proc in self.processors
+      for rsc in proc.resources() if index.get(rsc) is proc]
+
+  def build_resource(self,proc,rsc,outputdir):
+    """
+    Build a single resource with a processor, unless the manifest
+    shows that it is already up to date
+    """
+    self.build_resources(proc,[rsc],outputdir)
+
+  def build_resources(self,proc,rscs,outputdir):
+    """
+    Build resources with a processor, skipping those the manifest
+    shows are already up to date. Processors with a buildall method
+    are passed all remaining resources at once
+    """
+    recorded = getattr(proc,'recorded',False)
+    stale = []
+    for rsc in rscs:
+      dest = os.path.join(outputdir,rsc)
+      inputs = self._resource_inputs(proc,rsc)
+      if recorded:
+        # checked against the inputs and values recorded by the last build
+        fresh = self.manifest and self.manifest.explain(dest,
+          self._resource_key(proc,rsc),
+          values=dict(self.values,pages=self.pagesig)) is None
+      else:
+        fresh = (self.manifest and inputs is not None and
+          self.manifest.isfresh(dest,inputs,self._resource_key(proc,rsc)))
+      if fresh:
+        debug("skipping %s" % dest)
+      else:
+        stale.append(rsc)
+    if not stale:
+      return
+    name = proc.__class__.__name__
+    if hasattr(proc,'indir'):
+      name = "%s %s" % (name,proc.indir)
+    start = time.time()
+    recorders = {}
+    with span(name,'processor',resources=len(stale)):
+      if recorded:
+        for rsc in stale:
+          recorder = self.recorder = recorders[rsc] = DependencyRecorder()
+          try:
+            proc.build(rsc,outputdir)
+          finally:
+            self.recorder = None
+      elif hasattr(proc,'buildall'):
+        proc.buildall(stale,outputdir)
+      else:
+        for rsc in stale:
+          proc.build(rsc,outputdir)
+    cost = (time.time()-start)/len(stale)
+    for rsc in stale:
+      self.costs[rsc] = cost
+      dest = os.path.join(outputdir,rsc)
+      snapshot.forget(dest)
+      if self.manifest and snapshot.exists(dest):
+        inputs = self._resource_inputs(proc,rsc)
+        values = None
+        recorder = recorders.get(rsc)
+        if recorder is not None:
+          inputs = inputs+sorted(recorder.files)
+          values = dict(recorder.values)
+          if recorder.pages:
+            values['pages'] = self.pagesig
+        self.manifest.record(dest,inputs,self._resource_key(proc,rsc),
+          values=values or None)
+
+  def _resource_inputs(self,proc,rsc):
+    "Source files of a resource, None if not known"
+    if hasattr(proc,'inputs'):
+      return proc.inputs(rsc)
+    if hasattr(proc,'dependencies'):
+      return proc.dependencies(proc.path_from_resource(rsc))
+    if hasattr(proc,'path_from_resource'):
+      return [proc.path_from_resource(rsc)]
+    if hasattr(proc,'values'):
+      return []
+    return None
+
+  def _resource_key(self,proc,rsc):
+    """
+    Build key of a resource. Covers the values (other than files) it
+    is built from for processors which define values()
+    """
+    if hasattr(proc,'values'):
+      return hash_values(self.buildkey,proc.values(rsc))
+    return self.buildkey
       
   def clean(self):
-    if os.path.exists(DEFAULT_OUTPUT_DIR):
-      shutil.rmtree(DEFAULT_OUTPUT_DIR)
-    if os.path.exists(DEFAULT_PREVIEW_DIR):
-      shutil.rmtree(DEFAULT_PREVIEW_DIR)
+    clean()
       
   def inventory(self):
     "list the contents of the site to stdout"
@@ -347,17 +915,24 @@ class Site():
     for p in self.querypages():
       print p.name+".html"
 
-class Page():
+class Page(object):
   """
   A page is created for each markdown/html file in your pages/ 
   directory
   
+  Only the header of a page is held in memory. The body is read when
+  first needed and kept in the site's LRU of bodies, so that memory
+  grows with the number of pages rather than with their content
+  
   Attributes:
   site - parent
   header - dictionary of key/value pairs specifed in page file header
   path - file path to source file
+  body - source text after the header
   """
   # TODO: excerpt
+  __slots__ = ('site','path','type','name','header','title','template',
+    'tags','category','loadts')
   
   def __init__(self,site,path):
     self.site = site
@@ -366,8 +941,11 @@ class Page():
   
   # TODO: move the parsing of a page out of Page itself
   # and into the site - !
-  def _read(self):
-    "read the target file and parse returning header (dict) and content"
+  def _read(self,body=True):
+    """
+    read the target file and parse returning header (dict) and content.
+    Content is None unless body is True
+    """
     f = codecs.open(self.path, mode="r",encoding=self.site.encoding)
     line = f.readline().rstrip()
     header = {}
@@ -384,6 +962,9 @@ class Page():
      # convert foo-bar to foo_bar
      header[key] = value
      line = f.readline().rstrip()
+    if not body:
+      f.close()
+      return (header,None)
     lines = []
     line = 'X'
     while line:
@@ -393,19 +974,34 @@ class Page():
     return (header,body)
     
   def load(self):
-    (header,body) = self._read()
+    (header,body) = self._read(False)
+    strings = self.site._strings
+    share = lambda s: strings.setdefault(s,s)
     (rest,ext) = os.path.splitext(self.path)
-    self.type = ext[1:] # markdown or html
+    self.type = share(ext[1:]) # markdown or html
     # strip leading page dir 
     # TODO: this is just a little fragile
     self.name = self.path[6:].split('.')[0]
-    self.header = header
+    self.header = dict((share(k),v) for (k,v) in header.items())
     self.title = header.get('title',self.name)
-    self.template = header.get('template','default')
-    self.tags = re.split(r'\s*,\s*',header['tags']) if 'tags' in header else []
-    self.category = header.get('category')
-    self.body = body
-    self.loadts = os.path.getmtime(self.path)
+    self.template = share(header.get('template','default'))
+    if 'tags' in header:
+      self.tags = [share(tag) for tag in re.split(r'\s*,\s*',header['tags'])]
+    else:
+      self.tags = []
+    self.category = share(header['category']) if 'category' in header else None
+    self.site.bodies.discard(self.path)
+    self.loadts = snapshot.getmtime(self.path)
+
+  @property
+  def body(self):
+    self._used()
+    bodies = self.site.bodies
+    body = bodies.get(self.path)
+    if body is None:
+      body = self._read()[1]
+      bodies.put(self.path,body)
+    return body
   
   def url(self):
     "Absolute path to this page"
@@ -424,7 +1020,7 @@ class Page():
     if 'date-created' in self.header:
       dt = parse_datetime(self.header['date-created'])
     else:
-      dt = datetime.fromtimestamp(os.path.getctime(self.path))
+      dt = datetime.fromtimestamp(snapshot.getctime(self.path))
     if fmt:
       return dt.strftime(fmt)
     else:
@@ -436,46 +1032,86 @@ class Page():
     file
     """
     # TODO: allow to set date_modified on header?
-    dt = datetime.fromtimestamp(os.path.getmtime(self.path))
+    dt = datetime.fromtimestamp(snapshot.getmtime(self.path))
     if fmt:
       return dt.strftime(fmt)
     else:
       return dt
     
+  def _used(self):
+    "Record that the source of this page is used by what is rendering"
+    recorder = self.site.recorder
+    if recorder is not None:
+      recorder.files.add(self.path)
+
   def content(self):
     "Access the HTML content (without template) of this page"
+    self._used()
     if self.type == 'html':
       return self.body
     else:
-      return self.site.markdown.convert(self.body)
+      # the body is only read if the page changed since it was converted
+      return self.site.content_cache.convert_file(self.path,
+        lambda: self.body)
     
   def refresh(self):
     """Reload configuration if needed"""
-    if os.path.getmtime(self.path) != self.loadts:
+    if snapshot.getmtime(self.path) != self.loadts:
       self.load()
-  
+      self.site.index.add(self)
+
   def render(self):
     "Get the final HTML contents of the page and template as a string"
     t = self.site.load_template(self.template)
-    return t.render(
-      content=self.content(),
-      page=self,
-      site=self.site)
+    with span(self.name,'markdown'):
+      content = self.content()
+    with span(self.template,'template',page=self.name):
+      return t.render(
+        content=content,
+        page=self,
+        site=self.site)
       
   def make(self,outputdir):
     "Create the rendered page in the specified directory"
+    site = self.site
     f = os.path.join(outputdir,self.name+'.html')
+    manifest = site.manifest
+    if manifest:
+      reason = manifest.explain(f,site.buildkey,
+        values=dict(site.values,pages=site.pagesig))
+      if self.name in site.explain:
+        info("%s: %s" % (self.name,reason or "up to date"))
+      if reason is None:
+        debug("Up to date %s" % f)
+        return
     info("Rendering "+f)
     mkdir(os.path.dirname(f))
-    result = self.render()
-    if os.path.exists(f):
-      md5 = hashlib.md5()
-      md5.update(result.encode(self.site.encoding))
-      if md5.digest() == md5_for_file(f):
-        debug("Nothing changed %s" %f)
-        return
-    out = codecs.open(f,'w',encoding=self.site.encoding)
+    recorder = site.recorder = DependencyRecorder()
+    start = time.time()
     try:
-      out.write(result)
+      with span(self.name,'page'):
+        result = self.render().encode(site.encoding)
     finally:
-      out.close()
\ No newline at end of file
+      site.recorder = None
+    site.costs[self.name+'.html'] = time.time()-start
+    digest = hashlib.md5(result).hexdigest()
+    if manifest:
+      unchanged = manifest.unchanged(f,digest)
+    else:
+      unchanged = snapshot.exists(f) and md5hex_for_file(f) == digest
+    if unchanged:
+      debug("Nothing changed %s" %f)
+    else:
+      out = open(f,'wb')
+      try:
+        out.write(result)
+      finally:
+        out.close()
+      snapshot.forget(f)
+    if manifest:
+      inputs = ([self.path]+site.template_dependencies(self.template)+
+        sorted(recorder.files))
+      values = dict(recorder.values)
+      if recorder.pages:
+        values['pages'] = site.pagesig
+      manifest.record(f,inputs,site.buildkey,digest,values or None)
\ No newline at end of file
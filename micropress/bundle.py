@@ -0,0 +1,149 @@
+"""
+Concatenates resources into bundles published under fingerprinted
+names, so that pages make fewer requests and bundles can be served
+with long cache lifetimes.
+
+Configuration parameters:
+  bundles: mapping of bundle name to the resources it contains
+  bundle-minify: strip comments and whitespace from css bundles
+    (default true)
+
+For example
+
+  bundles:
+    css/site.css: [css/reset.css, css/style.css]
+    js/site.js: [js/jquery.js, js/app.js]
+
+is published as css/site.<hash>.css and js/site.<hash>.js, where hash
+is computed from the contents of the bundled sources.
+site.resource_href('css/site.css') returns the fingerprinted path. In
+preview mode bundles are published under their plain names. A page
+which links a bundle is rebuilt when its fingerprint changes.
+
+A bundle is rebuilt only when its sources (or the configuration)
+change, as recorded in the build manifest.
+"""
+
+from micropress import Publisher
+from micropress.util import info, mkdir, filestamp, md5hex_for_files
+from micropress.fs import snapshot
+import os.path
+import re
+import shutil
+import tempfile
+
+def minify_css(text):
+  "Remove comments and redundant whitespace from css"
+  text = re.sub(r'/\*.*?\*/','',text,flags=re.S)
+  text = re.sub(r'\s+',' ',text)
+  text = re.sub(r'\s*([{};,>])\s*',r'\1',text)
+  return text.replace(';}','}').strip()
+
+class BundleProcessor(Publisher):
+  """
+  Publishes each configured bundle under a fingerprinted name
+  """
+  def __init__(self,site):
+    self.site = site
+    # bundle -> (stamps of sources,fingerprint)
+    self._fingerprints = {}
+
+  def bundles(self):
+    return self.site.config.get('bundles',{})
+
+  def sources(self,bundle):
+    "Source files of all resources in a bundle"
+    sources = []
+    for member in self.bundles()[bundle]:
+      proc = self.publisher(member)
+      if proc is None:
+        raise Exception("No resource %s found for bundle %s" % (member,bundle))
+      src = proc.path_from_resource(member)
+      if hasattr(proc,'dependencies'):
+        sources.extend(proc.dependencies(src))
+      else:
+        sources.append(src)
+    return sources
+
+  def fingerprint(self,bundle):
+    "Hash of the contents of a bundle's sources"
+    sources = self.sources(bundle)
+    stamps = [filestamp(src) for src in sources]
+    cached = self._fingerprints.get(bundle)
+    if cached is None or cached[0] != stamps:
+      fingerprint = md5hex_for_files(*sources)[0:10]
+      self._fingerprints[bundle] = cached = (stamps,fingerprint)
+    return cached[1]
+
+  def published(self,bundle):
+    "Name under which a bundle is published"
+    if self.site.preview_mode:
+      return bundle
+    (name,ext) = os.path.splitext(bundle)
+    return "%s.%s%s" % (name,self.fingerprint(bundle),ext)
+
+  def alias(self,rsc):
+    "Published name for a bundle, None for other resources"
+    if rsc in self.bundles():
+      recorder = self.site.recorder
+      if recorder is not None:
+        recorder.values['bundle:'+rsc] = self.fingerprint(rsc)
+      return self.published(rsc)
+    return None
+
+  def hook(self,site,event):
+    "Set the current fingerprints of bundles before brewing"
+    if event != 'pre-brew':
+      return
+    for bundle in self.bundles():
+      site.values['bundle:'+bundle] = self.fingerprint(bundle)
+
+  def resources(self):
+    return [self.published(b) for b in sorted(self.bundles())]
+
+  def accept(self,rsc):
+    return rsc in self.resources()
+
+  def inputs(self,rsc):
+    "Source files of a published bundle"
+    return self.sources(self.bundle(rsc))
+
+  def bundle(self,rsc):
+    "Bundle published as rsc"
+    for bundle in self.bundles():
+      if self.published(bundle) == rsc:
+        return bundle
+    raise Exception("No bundle %s" % rsc)
+
+  def build(self,rsc,outdir):
+    bundle = self.bundle(rsc)
+    dest = os.path.join(outdir,rsc)
+    info("bundling %s" % dest)
+    members = self.bundles()[bundle]
+    tmp = tempfile.mkdtemp()
+    try:
+      parts = []
+      for member in members:
+        self.publisher(member).build(member,tmp)
+        parts.append(open(os.path.join(tmp,member),'rb').read())
+    finally:
+      shutil.rmtree(tmp)
+    if rsc.endswith('.js'):
+      data = ';\n'.join(parts)
+    else:
+      data = '\n'.join(parts)
+      if self.site.config.get('bundle-minify',True):
+        data = minify_css(data)
+    mkdir(os.path.dirname(dest))
+    f = open(dest,'wb')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    snapshot.forget(dest)
+
+def extend_micropress(site):
+  proc = BundleProcessor(site)
+  site.processors.append(proc)
+  site.resource_aliases.append(proc.alias)
+  site.hooks.append(proc.hook)
@@ -0,0 +1,186 @@
+"""
+micropress.cache
+
+Caches used to avoid repeating work within and across brews.
+
+  LRU - bounded in memory mapping
+  DiskCache - directory of files keyed by hash, bounded in total size
+  ContentCache - memoized markdown conversion backed by both
+"""
+
+import os
+import os.path
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+from micropress.util import mkdir, debug, filestamp
+
+# mode bits removed from files created by this process
+_umask = os.umask(0)
+os.umask(_umask)
+
+class LRU():
+  """
+  Mapping which holds at most maxitems entries, discarding the least
+  recently used entry when full
+  """
+  def __init__(self,maxitems):
+    self.maxitems = maxitems
+    self.items = OrderedDict()
+
+  def get(self,key,default=None):
+    if key not in self.items:
+      return default
+    value = self.items.pop(key)
+    self.items[key] = value
+    return value
+
+  def put(self,key,value):
+    self.items.pop(key,None)
+    self.items[key] = value
+    while len(self.items) > self.maxitems:
+      self.items.popitem(last=False)
+
+  def discard(self,key):
+    self.items.pop(key,None)
+
+  def clear(self):
+    self.items.clear()
+
+  def __contains__(self,key):
+    return key in self.items
+
+  def __len__(self):
+    return len(self.items)
+
+class DiskCache():
+  """
+  Directory of files keyed by a hash string. Files are written
+  atomically so that several processes may share a cache. If maxsize
+  (in bytes) is set the least recently used files are removed by
+  evict() until the cache fits
+  """
+  def __init__(self,dir,maxsize=None):
+    self.dir = dir
+    self.maxsize = maxsize
+    self.written = 0
+
+  def path(self,key):
+    "Path of the file which holds key"
+    return os.path.join(self.dir,key[0:2],key)
+
+  def get(self,key):
+    "Contents stored for key or None"
+    path = self.path(key)
+    try:
+      f = open(path,'rb')
+    except IOError:
+      return None
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    # mark as recently used
+    try:
+      os.utime(path,None)
+    except OSError:
+      pass
+    return data
+
+  def put(self,key,data):
+    "Store data under key"
+    path = self.path(key)
+    mkdir(os.path.dirname(path))
+    # unique even between machines sharing the directory
+    (fd,tmp) = tempfile.mkstemp('.tmp',key+'.',os.path.dirname(path))
+    # mkstemp creates files readable only by their owner
+    os.fchmod(fd,0666 & ~_umask)
+    f = os.fdopen(fd,'wb')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    try:
+      os.rename(tmp,path)
+    except OSError:
+      os.remove(tmp)
+      # another process stored the same key first
+      if not os.path.exists(path):
+        raise
+    self.written += len(data)
+
+  def evict(self):
+    "Remove least recently used files until the cache is below maxsize"
+    if self.maxsize is None or not os.path.exists(self.dir):
+      return
+    files = []
+    total = 0
+    for root, dirs, names in os.walk(self.dir):
+      for name in names:
+        path = os.path.join(root,name)
+        st = os.stat(path)
+        files.append((st.st_mtime,st.st_size,path))
+        total += st.st_size
+    files.sort()
+    for (mtime,size,path) in files:
+      if total <= self.maxsize:
+        break
+      debug("evicting %s" % path)
+      os.remove(path)
+      total -= size
+    self.written = 0
+
+class ContentCache():
+  """
+  Memoized markdown conversion. Results are keyed on the hash of the
+  source text and of the markdown configuration, held in memory for
+  the life of the site and persisted in a DiskCache between runs.
+  Conversions of files are also held by the stamp of the file, so that
+  they are found without reading it
+  """
+  def __init__(self,site,dir,maxsize=None,maxitems=1000):
+    self.site = site
+    self.memory = LRU(maxitems)
+    self.files = LRU(maxitems)
+    self.disk = DiskCache(dir,maxsize)
+    self.confighash = None
+
+  def key(self,text):
+    if self.confighash is None:
+      import markdown
+      md5 = hashlib.md5()
+      md5.update(getattr(markdown,'__version__',None) or markdown.version)
+      md5.update(repr(sorted(self.site.config.get('markdown',{}).items())))
+      self.confighash = md5.hexdigest()
+    md5 = hashlib.md5(self.confighash)
+    md5.update(text.encode('utf8'))
+    return md5.hexdigest()
+
+  def convert(self,text):
+    "Convert markdown text to HTML"
+    key = self.key(text)
+    html = self.memory.get(key)
+    if html is None:
+      data = self.disk.get(key)
+      if data is not None:
+        html = data.decode('utf8')
+      else:
+        md = self.site.markdown
+        md.reset()
+        html = md.convert(text)
+        self.disk.put(key,html.encode('utf8'))
+      self.memory.put(key,html)
+    return html
+
+  def convert_file(self,path,read):
+    """
+    Convert the markdown of a file, calling read() for its text only if
+    the file changed since it was last converted
+    """
+    stamp = (path,)+tuple(filestamp(path))
+    html = self.files.get(stamp)
+    if html is None:
+      html = self.convert(read())
+      self.files.put(stamp,html)
+    return html
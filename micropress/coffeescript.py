@@ -5,8 +5,9 @@ on your path
 """
 
 from micropress import Processor
-from micropress.util import exectool
+from micropress.util import exectools, toolversion, md5hex_for_files
 import os.path
+import hashlib
 
 class CoffeescriptProcessor(Processor):
   def __init__(self):
@@ -20,9 +21,20 @@ class CoffeescriptProcessor(Processor):
     (name,ext) = os.path.splitext(rsc) 
     return name+".coffee"
     
-  def _dobuild(self,src,dest):
-    outdir = os.path.dirname(dest)
-    exectool('coffee','-c','-o',outdir,src);
+  def cachekey(self,src):
+    md5 = hashlib.md5()
+    md5.update(toolversion('coffee'))
+    md5.update('-c')
+    md5.update(md5hex_for_files(src))
+    return md5.hexdigest()
+    
+  def _dobuildall(self,builds):
+    # coffee compiles many files into one output directory per invocation
+    byoutdir = {}
+    for (src,dest) in builds:
+      byoutdir.setdefault(os.path.dirname(dest),[]).append(src)
+    exectools(('coffee','-c','-o',outdir)+tuple(srcs)
+      for (outdir,srcs) in sorted(byoutdir.items()))
     
 def extend_micropress(site):
   site.processors.append(CoffeescriptProcessor())
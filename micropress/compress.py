@@ -0,0 +1,114 @@
+"""
+micropress.compress
+
+Writes precompressed variants (foo.html.gz and, if the brotli module
+is installed, foo.html.br) next to brewed files, for servers that can
+serve them directly. Enabled in site.yaml with
+
+  compress: true
+
+or with options
+
+  compress:
+    types: [.html, .css, .js]  # extensions of files to compress
+    min-size: 256              # smaller files are not compressed
+    brotli: false              # only write .gz variants
+
+Variants are recorded in the build manifest against the hash of the
+file they were compressed from, so a file which did not change in a
+brew is not compressed again.
+"""
+
+import os
+import os.path
+import gzip
+import hashlib
+import multiprocessing
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+from micropress.util import info, debug
+from micropress.fs import snapshot
+
+DEFAULT_TYPES = ['.html','.css','.js','.xml','.json','.txt','.svg']
+
+def gzip_bytes(data):
+  "gzip data, without a timestamp so that output is reproducible"
+  buf = StringIO()
+  f = gzip.GzipFile(mode='wb',fileobj=buf,compresslevel=9,mtime=0)
+  f.write(data)
+  f.close()
+  return buf.getvalue()
+
+ENCODINGS = {
+  'gz': gzip_bytes,
+  'br': brotli and brotli.compress,
+}
+
+def _compress(task):
+  "Write a compressed variant of a file, returning the variant's md5"
+  (path,encoding) = task
+  data = ENCODINGS[encoding](open(path,'rb').read())
+  variant = path+'.'+encoding
+  tmp = "%s.%i.tmp" % (variant,os.getpid())
+  f = open(tmp,'wb')
+  try:
+    f.write(data)
+  finally:
+    f.close()
+  os.rename(tmp,variant)
+  return hashlib.md5(data).hexdigest()
+
+def compress_outputs(site,outputdir,jobs=None,outputs=None):
+  """
+  Write compressed variants of the files recorded in the manifest for
+  outputdir (only those in outputs if given), if enabled by the site
+  configuration. Returns the paths of all variants, written or not
+  """
+  config = site.config.get('compress')
+  if not config:
+    return []
+  if config is True:
+    config = {}
+  types = config.get('types',DEFAULT_TYPES)
+  minsize = config.get('min-size',256)
+  encodings = ['gz']
+  if config.get('brotli',True) and brotli is not None:
+    encodings.append('br')
+  manifest = site.manifest
+  prefix = os.path.join(outputdir,'')
+  tasks = []
+  variants = []
+  for (path,entry) in sorted(manifest.entries.items()):
+    (mtime,size,digest) = entry['output']
+    if outputs is not None and path not in outputs:
+      continue
+    if (not path.startswith(prefix) or size < minsize or
+        os.path.splitext(path)[1] not in types or
+        not snapshot.exists(path)):
+      continue
+    for encoding in encodings:
+      variants.append(path+'.'+encoding)
+      if manifest.isfresh(path+'.'+encoding,[],encoding,dict(source=digest)):
+        debug("skipping %s.%s" % (path,encoding))
+      else:
+        tasks.append((path,encoding,digest))
+  if not tasks:
+    return variants
+  info("compressing %i files" % len(tasks))
+  pool = ThreadPool(jobs or multiprocessing.cpu_count())
+  try:
+    digests = pool.map(_compress,[(path,encoding) for (path,encoding,d) in tasks])
+  finally:
+    pool.close()
+    pool.join()
+  for ((path,encoding,source),digest) in zip(tasks,digests):
+    variant = path+'.'+encoding
+    snapshot.forget(variant)
+    manifest.record(variant,[],encoding,digest,dict(source=source))
+  return variants
@@ -1,23 +1,171 @@
 """
 Defines utility methods for loading JSON from local filesystem or
 over the network
+
+Templates call site.ext.json(url). Each file or url is parsed once per
+brew, and the same (shared, do not modify it) data is returned to
+every page. Files are read again when their mtime changes.
+
+Data fetched over http(s) is also cached on disk (in .micropress/data)
+for data-ttl seconds. After that it is revalidated with the server
+(If-None-Match/If-Modified-Since), and if the server cannot be reached
+the cached copy is used.
+
+Urls used by the previous brew, and those listed in data-prefetch, are
+fetched concurrently before anything is built. A page which used a url
+is rebuilt when the data fetched from it changes.
+
+Configuration parameters:
+  data-ttl: seconds that fetched data is used without revalidation
+    (default 300)
+  data-timeout: seconds to wait for a server (default 10)
+  data-prefetch: list of urls to fetch before the brew
+  data-jobs: number of urls fetched at once (default 8)
 """
 
 # allows up to import json even though we are called json
 # See: http://docs.python.org/whatsnew/2.5.html#pep-328
 from __future__ import absolute_import
+import os.path
+import time
+import socket
+import hashlib
 import urllib2
 import json as jsonlib
+from multiprocessing.pool import ThreadPool
+
+from micropress import CACHE_DIR
+from micropress.cache import DiskCache
+from micropress.util import info, debug, filestamp
+
+DATA_CACHE_DIR = os.path.join(CACHE_DIR,'data')
+
+def isurl(url):
+  return url.startswith('http:') or url.startswith('https:')
 
 # SEE: How not to fetch data over HTTP
 # http://diveintopython.org/http_web_services/review.html
-def loadjson(url):
+def loadjson(url,timeout=10):
   """load url from JSON"""
-  if url.startswith("http:"):
-    response = urllib2.urlopen(url)
+  if isurl(url):
+    response = urllib2.urlopen(url,timeout=timeout)
     return jsonlib.load(response)
   else:
     return jsonlib.load(open(url,'r'))
 
+class DataLoader():
+  """
+  Memoized loading of JSON for a site
+  """
+  def __init__(self,site):
+    self.site = site
+    self.disk = DiskCache(DATA_CACHE_DIR)
+    # url -> (token,data,digest). token is the file's stamp for files,
+    # the site generation for urls
+    self._memo = {}
+
+  def _fetch(self,url):
+    "Body of url, from the disk cache if fresh or still valid"
+    config = self.site.config
+    key = hashlib.md5(url).hexdigest()
+    cached = self.disk.get(key)
+    record = jsonlib.loads(cached) if cached else None
+    now = time.time()
+    if record and now-record['fetched'] < config.get('data-ttl',300):
+      debug("%s from cache" % url)
+      return record['body']
+    request = urllib2.Request(url)
+    if record and record.get('etag'):
+      request.add_header('If-None-Match',record['etag'])
+    if record and record.get('last-modified'):
+      request.add_header('If-Modified-Since',record['last-modified'])
+    try:
+      response = urllib2.urlopen(request,timeout=config.get('data-timeout',10))
+      try:
+        body = response.read()
+      finally:
+        response.close()
+      headers = response.info()
+      record = {'url':url,'body':body,'etag':headers.getheader('ETag'),
+        'last-modified':headers.getheader('Last-Modified')}
+      debug("fetched %s" % url)
+    except urllib2.HTTPError, e:
+      if e.code != 304 or record is None:
+        raise
+      debug("%s not modified" % url)
+    except (urllib2.URLError,socket.error), e:
+      if record is None:
+        raise
+      info("%s unavailable (%s), using cached copy" % (url,e))
+      return record['body']
+    record['fetched'] = now
+    self.disk.put(key,jsonlib.dumps(record))
+    return record['body']
+
+  def _memoized(self,url):
+    "(token,data,digest) for url, loading it if needed"
+    if isurl(url):
+      token = self.site.generation
+    else:
+      token = filestamp(url)
+    memo = self._memo.get(url)
+    if memo is None or memo[0] != token:
+      if isurl(url):
+        body = self._fetch(url)
+      else:
+        body = open(url,'rb').read()
+      memo = (token,jsonlib.loads(body),hashlib.md5(body).hexdigest())
+      self._memo[url] = memo
+    return memo
+
+  def load(self,url):
+    "Data of a JSON file or url"
+    (token,data,digest) = self._memoized(url)
+    recorder = self.site.recorder
+    if recorder is not None:
+      if isurl(url):
+        recorder.values['data:'+url] = digest
+      else:
+        recorder.files.add(url)
+    return data
+
+  def _prefetch(self,url):
+    try:
+      return self._memoized(url)[2]
+    except Exception, e:
+      info("failed to prefetch %s (%s)" % (url,e))
+      return None
+
+  def prefetch(self,urls):
+    """
+    Fetch urls concurrently, setting the site values of pages which
+    depend on them
+    """
+    urls = sorted(set(urls))
+    if not urls:
+      return
+    pool = ThreadPool(min(len(urls),self.site.config.get('data-jobs',8)))
+    try:
+      digests = pool.map(self._prefetch,urls)
+    finally:
+      pool.close()
+      pool.join()
+    for (url,digest) in zip(urls,digests):
+      if digest is not None:
+        self.site.values['data:'+url] = digest
+
+  def hook(self,site,event):
+    "Prefetch urls used by the previous brew before brewing"
+    if event != 'pre-brew':
+      return
+    urls = set(site.config.get('data-prefetch',[]))
+    for entry in site.manifest.entries.values():
+      for name in entry.get('values',{}):
+        if name.startswith('data:'):
+          urls.add(name[5:])
+    self.prefetch(urls)
+
 def extend_micropress(site):
-  site.ext['json'] = loadjson
\ No newline at end of file
+  loader = DataLoader(site)
+  site.ext['json'] = loader.load
+  site.hooks.append(loader.hook)
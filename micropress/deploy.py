@@ -0,0 +1,88 @@
+"""
+micropress.deploy
+
+What a brew changed in the output directory, so that a deploy need
+only upload that. Outputs are compared by content hash against those
+recorded in the build manifest by the previous brew:
+
+  added - outputs which did not exist before
+  modified - outputs whose contents changed
+  deleted - outputs of the previous brew which the site no longer
+    publishes (for example of a removed page). These are removed
+
+The changes of the last brew are written to .micropress/changes.json
+
+  {
+    "added": {"feeds/tag/new.xml": "9e10..."},
+    "modified": {"index.html": "a0b1..."},
+    "deleted": ["old.html"]
+  }
+
+with paths relative to the output directory. export() copies the
+added and modified files to a staging directory.
+"""
+
+import os
+import os.path
+
+from micropress.util import info, debug, mkdir, publish, save_json
+from micropress.fs import snapshot
+
+def changes(manifest,outputdir,before,outputs):
+  """
+  Changes between the outputs recorded in manifest before a brew
+  (output -> md5, see BuildManifest.outputs) and the set of outputs
+  published by the brew. Orphaned outputs are removed from the output
+  directory and from the manifest
+  """
+  prefix = os.path.join(outputdir,'')
+  result = dict(added={},modified={},deleted=[])
+  for dest in sorted(outputs):
+    entry = manifest.get(dest)
+    if entry is None:
+      continue
+    digest = entry['output'][2]
+    rel = dest[len(prefix):]
+    if dest not in before:
+      result['added'][rel] = digest
+    elif before[dest] != digest:
+      result['modified'][rel] = digest
+  for dest in sorted(set(before)-set(outputs)):
+    result['deleted'].append(dest[len(prefix):])
+    remove_output(dest,outputdir)
+    manifest.forget(dest)
+  info("%i outputs added, %i modified, %i deleted" % (len(result['added']),
+    len(result['modified']),len(result['deleted'])))
+  return result
+
+def remove_output(dest,outputdir):
+  "Remove an output file along with directories left empty"
+  if os.path.lexists(dest):
+    info("removing %s" % dest)
+    os.remove(dest)
+  snapshot.forget(dest)
+  dir = os.path.dirname(dest)
+  while (dir and os.path.normpath(dir) != os.path.normpath(outputdir) and
+      os.path.isdir(dir) and not os.listdir(dir)):
+    os.rmdir(dir)
+    snapshot.forget(dir)
+    dir = os.path.dirname(dir)
+
+def save(changes,path):
+  save_json(changes,path,indent=1,sort_keys=True)
+
+def export(outputdir,changes,dir):
+  """
+  Copy the files added or modified by a brew from outputdir to dir,
+  along with the changes (as changes.json) so that deleted files can
+  be removed by the deploy
+  """
+  names = sorted(changes['added'].keys()+changes['modified'].keys())
+  for name in names:
+    dest = os.path.join(dir,name)
+    mkdir(os.path.dirname(dest))
+    debug("exporting %s" % name)
+    # never hardlink, a later brew would write through the link
+    publish(os.path.join(outputdir,name),dest,'reflink')
+  save(changes,os.path.join(dir,'changes.json'))
+  info("exported %i files to %s" % (len(names),dir))
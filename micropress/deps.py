@@ -0,0 +1,64 @@
+"""
+micropress.deps
+
+Tracks what a page is built from so that the build manifest only
+rebuilds pages that are affected by a change. A page depends on
+
+  * its source file
+  * its template and every template it extends, includes or imports
+  * files read through Site.getcontents() while rendering
+  * the headers of all pages, if it called Site.querypages()/Site.page()
+  * the source of every page whose content() or body it used
+  * values in Site.values it used, such as remote data
+
+Template dependencies are found statically by parsing templates.
+Everything else is recorded while the page renders.
+"""
+
+import os.path
+
+class DependencyRecorder():
+  """
+  Collects dynamic dependencies while a page renders
+
+  Attributes:
+    files - set of files read through Site.getcontents() and sources of
+      pages whose content was used
+    pages - True if other pages were queried
+    values - names of Site.values used and their values
+  """
+  def __init__(self):
+    self.files = set()
+    self.pages = False
+    self.values = {}
+
+def referenced_templates(env,name):
+  """
+  Names of templates directly referenced by a template, or None if it
+  references a template by a dynamic expression
+  """
+  from jinja2 import meta
+  (source,filename,uptodate) = env.loader.get_source(env,name)
+  refs = list(meta.find_referenced_templates(env.parse(source)))
+  if None in refs:
+    return None
+  return refs
+
+def template_closure(env,name,templatedir):
+  """
+  Files of a template and all templates that it references (directly
+  or indirectly). Returns None if the closure could not be determined
+  statically
+  """
+  seen = set()
+  pending = [name]
+  while pending:
+    t = pending.pop()
+    if t in seen:
+      continue
+    seen.add(t)
+    refs = referenced_templates(env,t)
+    if refs is None:
+      return None
+    pending.extend(refs)
+  return sorted(os.path.join(templatedir,t) for t in seen)
@@ -0,0 +1,131 @@
+"""
+micropress.fs
+
+A snapshot of filesystem metadata shared by everything in micropress
+that needs to stat or list files. Each path is stat'ed and each
+directory listed at most once until the snapshot is explicitly
+refreshed (loading a Site, Site.refresh() and Site.brew() do so),
+which matters on network filesystems where every stat is a round trip.
+
+The number of real calls made to the filesystem is counted in
+snapshot.syscalls.
+"""
+
+import os
+import os.path
+import stat
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+class Snapshot():
+  """
+  Cache of os.stat() results and directory listings. A missing file
+  is cached as None
+  """
+  def __init__(self):
+    self.syscalls = 0
+    self.invalidate()
+
+  def invalidate(self):
+    "Forget everything, subsequent calls go to the filesystem"
+    self._stats = {}
+    self._listings = {}
+
+  def forget(self,path):
+    """
+    Forget a path which has been (re)written, added or removed, along
+    with its directory (whose listing and mtime may have changed)
+    """
+    dir = os.path.dirname(path)
+    self._stats.pop(path,None)
+    self._stats.pop(dir,None)
+    self._listings.pop(path,None)
+    self._listings.pop(dir,None)
+
+  def stat(self,path):
+    "os.stat() of path or None if it does not exist"
+    if path not in self._stats:
+      self.syscalls += 1
+      try:
+        self._stats[path] = os.stat(path)
+      except OSError:
+        self._stats[path] = None
+    return self._stats[path]
+
+  def exists(self,path):
+    return self.stat(path) is not None
+
+  def isdir(self,path):
+    st = self.stat(path)
+    return st is not None and stat.S_ISDIR(st.st_mode)
+
+  def _stat_or_raise(self,path):
+    st = self.stat(path)
+    if st is None:
+      raise OSError(2,"No such file or directory",path)
+    return st
+
+  def getmtime(self,path):
+    return self._stat_or_raise(path).st_mtime
+
+  def getctime(self,path):
+    return self._stat_or_raise(path).st_ctime
+
+  def listdir(self,dir):
+    """
+    (dirs,files) directly within dir, or None if dir does not
+    exist. Names are sorted
+    """
+    if dir not in self._listings:
+      self._listings[dir] = self._scan(dir)
+    return self._listings[dir]
+
+  def _scan(self,dir):
+    dirs = []
+    files = []
+    self.syscalls += 1
+    if scandir is not None:
+      try:
+        entries = list(scandir(dir))
+      except OSError:
+        return None
+      for entry in entries:
+        # d_type from the directory listing - no stat needed
+        if entry.is_dir():
+          dirs.append(entry.name)
+        else:
+          files.append(entry.name)
+    else:
+      try:
+        names = os.listdir(dir)
+      except OSError:
+        return None
+      for name in names:
+        if self.isdir(os.path.join(dir,name)):
+          dirs.append(name)
+        else:
+          files.append(name)
+    return (sorted(dirs),sorted(files))
+
+  def walk(self,top):
+    """
+    Like os.walk(top) (topdown). dirs may be modified in place to prune
+    the walk
+    """
+    listing = self.listdir(top)
+    if listing is None:
+      return
+    dirs = list(listing[0])
+    yield (top,dirs,list(listing[1]))
+    for d in dirs:
+      for result in self.walk(os.path.join(top,d)):
+        yield result
+
+# the snapshot used by micropress
+snapshot = Snapshot()
@@ -0,0 +1,143 @@
+"""
+micropress.index
+
+Indexes over the pages of a site used to answer Site.querypages()
+without scanning and sorting every page on each call.
+
+  tag -> set of pages
+  category -> set of pages
+  order -> pages sorted by date_created, date_modified or title
+
+Indexes are kept up to date page by page as pages are added, removed
+or reloaded. Orders are sorted when first queried.
+"""
+
+from bisect import bisect_left, insort
+
+# order name -> (sort key of a page, newest/largest first)
+ORDERS = {
+  None: (lambda p: p.name, False),
+  'date_created': (lambda p: p.date_created(), True),
+  'date_modified': (lambda p: p.date_modified(), True),
+  'title': (lambda p: p.title, False),
+}
+
+class PageIndex():
+  """
+  Maintained indexes over a collection of pages. Pages are identified
+  by name. Each order is sorted when first queried, so that a page
+  whose date cannot be parsed only fails queries ordered by date
+  """
+  def __init__(self,pages=()):
+    self.pages = {}
+    self.bytag = {}
+    self.bycategory = {}
+    # order -> sorted list of (key,name), for orders queried so far
+    self.sorted = {}
+    # name -> {order: key} as inserted, needed to remove a page
+    self._keys = {}
+    # name -> (tags,category) as indexed
+    self._indexed = {}
+    for p in pages:
+      self.add(p)
+
+  def add(self,page):
+    "Add a page to the index (replacing a page of the same name)"
+    name = page.name
+    if name in self.pages:
+      self.remove(name)
+    self.pages[name] = page
+    tags = list(page.tags)
+    for tag in tags:
+      self.bytag.setdefault(tag,set()).add(name)
+    if page.category is not None:
+      self.bycategory.setdefault(page.category,set()).add(name)
+    self._indexed[name] = (tags,page.category)
+    keys = self._keys[name] = {}
+    for (order,entries) in self.sorted.items():
+      keys[order] = ORDERS[order][0](page)
+      insort(entries,(keys[order],name))
+
+  def remove(self,name):
+    "Remove a page from the index by name"
+    page = self.pages.pop(name,None)
+    if page is None:
+      return
+    (tags,category) = self._indexed.pop(name)
+    for tag in tags:
+      names = self.bytag[tag]
+      names.discard(name)
+      if not names:
+        del self.bytag[tag]
+    if category is not None:
+      names = self.bycategory[category]
+      names.discard(name)
+      if not names:
+        del self.bycategory[category]
+    keys = self._keys.pop(name)
+    for (order,entries) in self.sorted.items():
+      ix = bisect_left(entries,(keys[order],name))
+      del entries[ix]
+
+  def _sorted(self,order):
+    "(key,name) of every page sorted by order, sorting them if needed"
+    if order not in self.sorted:
+      key = ORDERS[order][0]
+      entries = []
+      for (name,page) in self.pages.items():
+        self._keys[name][order] = key(page)
+        entries.append((self._keys[name][order],name))
+      entries.sort()
+      self.sorted[order] = entries
+    return self.sorted[order]
+
+  def tags(self):
+    "All tags in use"
+    return sorted(self.bytag)
+
+  def categories(self):
+    "All categories in use"
+    return sorted(self.bycategory)
+
+  def ordered(self,order=None):
+    "Iterate over page names in the specified order"
+    (key,reverse) = ORDERS[order]
+    entries = self._sorted(order)
+    if reverse:
+      entries = reversed(entries)
+    for (k,name) in entries:
+      yield name
+
+  def query(self,tags=(),category=None,order=None,offset=0,maxitems=None):
+    """
+    Pages having all of tags and category (if not None), sorted by
+    order. offset/maxitems select a slice of the result
+    """
+    if order not in ORDERS:
+      raise Exception("Unknown page order %s" % order)
+    candidates = None
+    filters = [self.bytag.get(t,set()) for t in tags]
+    if category is not None:
+      filters.append(self.bycategory.get(category,set()))
+    if filters:
+      filters.sort(key=len)
+      candidates = filters[0].intersection(*filters[1:])
+    result = []
+    end = None if maxitems is None else offset+maxitems
+    if end is not None and end <= offset:
+      return []
+    self._sorted(order)
+    if candidates is not None and len(candidates) < len(self.pages)/4:
+      # small selection - sort it rather than walking the whole order
+      (key,reverse) = ORDERS[order]
+      keys = self._keys
+      names = sorted(candidates,key=lambda n: (keys[n][order],n),
+        reverse=reverse)
+      return [self.pages[n] for n in names[offset:end]]
+    for name in self.ordered(order):
+      if candidates is not None and name not in candidates:
+        continue
+      result.append(self.pages[name])
+      if end is not None and len(result) >= end:
+        break
+    return result[offset:]
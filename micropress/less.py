@@ -8,8 +8,12 @@ TODO: optionally minify CSS
 """
 
 from micropress import Processor
-from micropress.util import exectool
+from micropress.util import exectools, toolversion, md5hex_for_files
 import os.path
+import re
+import hashlib
+
+IMPORT_RE = re.compile(r"""@import\s+(?:url\()?\s*["']?([^"')\s;]+)""")
 
 class LessProcessor(Processor):
   """docstring for CoffeescriptProcessor"""
@@ -26,12 +30,42 @@ class LessProcessor(Processor):
     (name,ext) = os.path.splitext(rsc) 
     return name+".less"
     
-  def _dobuild(self,src,dest):
-    args = [src,dest]
+  def options(self):
+    "lessc command line options"
     # output compressed unless in preview mode
     if not self.site.preview_mode:
-      args.append('-x') 
-    exectool('lessc',*args);
+      return ['-x']
+    return []
+
+  def dependencies(self,src):
+    "src and every file it (transitively) @imports"
+    deps = []
+    pending = [src]
+    while pending:
+      path = pending.pop(0)
+      if path in deps or not os.path.exists(path):
+        continue
+      deps.append(path)
+      dir = os.path.dirname(path)
+      for name in IMPORT_RE.findall(open(path).read()):
+        if '://' in name:
+          continue
+        if not os.path.splitext(name)[1]:
+          name += '.less'
+        pending.append(os.path.normpath(os.path.join(dir,name)))
+    return deps
+
+  def cachekey(self,src):
+    md5 = hashlib.md5()
+    md5.update(toolversion('lessc'))
+    md5.update(' '.join(self.options()))
+    md5.update(md5hex_for_files(*self.dependencies(src)))
+    return md5.hexdigest()
+    
+  def _dobuildall(self,builds):
+    # lessc compiles one file per invocation, so run several at once
+    exectools(tuple(['lessc',src,dest]+self.options())
+      for (src,dest) in builds)
     
 def extend_micropress(site):
   site.processors.append(LessProcessor(site))
@@ -0,0 +1,157 @@
+"""
+Generates paginated listing pages of the pages with each tag, in each
+category and created in each month, rendered with
+templates/listing.tmpl
+
+Configuration parameters:
+  listing-tags: list pages by tag at tag/<tag>/index.html (default true)
+  listing-categories: list pages by category at
+    category/<category>/index.html (default true)
+  listing-dates: list pages by month at archive/<yyyy>/<mm>/index.html
+    (default true)
+  listing-size: number of pages per listing page (default 20). Further
+    pages are 2.html, 3.html, ... next to index.html
+  listing-order: order of pages, as for site.querypages() (default
+    date_created)
+  listing-template: template to render (default listing)
+
+Tags or categories which make the same path (C++ and C) are told apart
+by a short hash suffix, e.g. tag/C-1a2b3c/index.html.
+
+The template is rendered with site and listing (also passed as page,
+so that templates written for pages can be extended) which has
+attributes
+  kind - 'tag', 'category' or 'date'
+  key - the tag, category or datetime of the month
+  title - the tag, category or month (e.g. June 2011)
+  pages - pages listed on this page
+  number, count - number of this page and count of pages in the listing
+  href, first, prev, next - names of this, the first, previous and next
+    pages of the listing (prev/next are None at either end)
+
+Every listing is computed from a single walk over the pages. Each
+listing page is rebuilt only when the pages it lists (or their
+headers), its template, files and data it reads or the configuration
+change.
+"""
+
+from micropress import ResourceFactory
+from micropress.manifest import hash_values
+from micropress.util import mkdir, info, slugs
+import os.path
+from datetime import datetime
+
+class Listing():
+  "One page of a listing"
+  def __init__(self,kind,key,dir,number,count,pages):
+    self.kind = kind
+    self.key = key
+    if kind == 'date':
+      self.title = key.strftime('%B %Y')
+    else:
+      self.title = key
+    self.pages = pages
+    self.number = number
+    self.count = count
+    self.href = self.pagename(dir,number)
+    self.first = self.pagename(dir,1)
+    self.prev = self.pagename(dir,number-1) if number > 1 else None
+    self.next = self.pagename(dir,number+1) if number < count else None
+
+  @staticmethod
+  def pagename(dir,number):
+    if number == 1:
+      return dir+'/index.html'
+    return "%s/%i.html" % (dir,number)
+
+class ListingProcessor(ResourceFactory):
+  """
+  Publishes the listing pages of a site
+  """
+  recorded = True
+
+  def __init__(self,site):
+    ResourceFactory.__init__(self,site,None)
+
+  def template(self):
+    return self.site.config.get('listing-template','listing')
+
+  def groups(self):
+    "(kind,key,dir) -> names of pages, in order, from one walk of the pages"
+    site = self.site
+    config = site.config
+    tags = config.get('listing-tags',True)
+    categories = config.get('listing-categories',True)
+    dates = config.get('listing-dates',True)
+    tagslugs = slugs(site.index.tags(),'tags') if tags else {}
+    categoryslugs = slugs(site.index.categories(),'categories') \
+      if categories else {}
+    groups = {}
+    for name in site.index.ordered(config.get('listing-order','date_created')):
+      page = site.index.pages[name]
+      keys = []
+      if tags:
+        keys.extend(('tag',tag,'tag/'+tagslugs[tag]) for tag in page.tags)
+      if categories and page.category is not None:
+        keys.append(('category',page.category,
+          'category/'+categoryslugs[page.category]))
+      if dates:
+        created = page.date_created()
+        month = datetime(created.year,created.month,1)
+        keys.append(('date',month,month.strftime('archive/%Y/%m')))
+      for key in keys:
+        groups.setdefault(key,[]).append(name)
+    return groups
+
+  def listings(self):
+    "Resource name -> Listing of every listing page. Computed once per brew"
+    return self.per_brew('listings',self._listings)
+
+  def _listings(self):
+    size = self.site.config.get('listing-size',20)
+    listings = {}
+    for ((kind,key,dir),names) in self.groups().items():
+      count = (len(names)+size-1)/size
+      for number in range(1,count+1):
+        pages = names[(number-1)*size:number*size]
+        listing = Listing(kind,key,dir,number,count,pages)
+        listings[listing.href] = listing
+    return listings
+
+  def resources(self):
+    return sorted(self.listings())
+
+  def accept(self,rsc):
+    return rsc in self.listings()
+
+  def inputs(self,rsc):
+    "Files of the listing template"
+    return self.site.template_dependencies(self.template())
+
+  def values(self,rsc):
+    "The pages (and their headers) a listing page lists"
+    listing = self.listings()[rsc]
+    pages = self.site.pages
+    return dict(listing=hash_values(listing.number,listing.count,
+      [(name,pages[name].header) for name in listing.pages]))
+
+  def build(self,rsc,outdir):
+    site = self.site
+    listing = self.listings()[rsc]
+    # names to pages, for the template
+    pages = [site.pages[name] for name in listing.pages]
+    listing = Listing(listing.kind,listing.key,os.path.dirname(rsc),
+      listing.number,listing.count,pages)
+    dest = os.path.join(outdir,rsc)
+    info("Rendering "+dest)
+    mkdir(os.path.dirname(dest))
+    html = site.load_template(self.template()).render(site=site,
+      listing=listing,page=listing)
+    f = open(dest,'wb')
+    try:
+      f.write(html.encode(site.encoding))
+    finally:
+      f.close()
+
+def extend_micropress(site):
+  site.processors.append(ListingProcessor(site))
@@ -6,26 +6,55 @@ module for invoking micropress on the command line
 """
 
 from micropress import Site,SITE_CONFIG_PATH,DEFAULT_OUTPUT_DIR
+import micropress
+from micropress import profiling, deploy, shard
 import sys
 import argparse
 import shutil
 import os.path
 
 def brew(args):
+  if args.profile:
+    profiler = profiling.enable()
   site = Site(SITE_CONFIG_PATH)
-  site.brew(args.outputdir)
+  site.explain.update(args.explain)
+  site.brew(args.outputdir,args.jobs,args.shard)
+  if args.export:
+    deploy.export(args.outputdir,site.changes,args.export)
+  if args.profile:
+    profiler.save(args.profile)
+    for line in profiler.summary(args.top):
+      print line
+    print "trace written to %s" % args.profile
   
+def merge(args):
+  site = Site(SITE_CONFIG_PATH)
+  site.merge(args.outputdir,args.sharddirs,args.jobs)
+  if args.export:
+    deploy.export(args.outputdir,site.changes,args.export)
+
+def shardspec(spec):
+  try:
+    return shard.parse(spec)
+  except ValueError, e:
+    raise argparse.ArgumentTypeError(str(e))
+
 def preview(args):
   import micropress.web  
   site = Site(SITE_CONFIG_PATH)  
   micropress.web.run(site,args.host,args.port)
   
 def clean(args):
+  # nothing to load
+  micropress.clean()
+
+def precompile(args):
   site = Site(SITE_CONFIG_PATH)
-  site.clean()
+  names = site.precompile()
+  print "compiled %i templates" % len(names)
 
 def inventory(args):
-  site = Site(SITE_CONFIG_PATH) 
+  site = Site(SITE_CONFIG_PATH)
   site.inventory()
 
 def run(argv):
@@ -36,7 +65,40 @@ def run(argv):
   parser_brew.add_argument('-d', metavar='DIR', type=str,
                       default=DEFAULT_OUTPUT_DIR,dest='outputdir',
                       help='Alternate output dir')
+  parser_brew.add_argument('-j','--jobs', metavar='N', type=int,
+                      default=1,dest='jobs',
+                      help='Number of worker processes')
+  parser_brew.add_argument('--explain', metavar='PAGE', type=str,
+                      default=[],action='append',dest='explain',
+                      help='Print why a page is (re)built')
+  parser_brew.add_argument('--export', metavar='DIR', type=str,
+                      default=None,dest='export',
+                      help='Copy only the files changed by this brew to DIR')
+  parser_brew.add_argument('--profile', metavar='FILE', type=str,
+                      default=None,dest='profile',
+                      help='Write a Chrome trace of the brew to FILE')
+  parser_brew.add_argument('--top', metavar='N', type=int,
+                      default=10,dest='top',
+                      help='Number of slowest pages, templates, etc to print with --profile')
+  parser_brew.add_argument('--shard', metavar='I/N', type=shardspec,
+                      default=None,dest='shard',
+                      help='Build only the I-th of N shares of the site, to be merged')
   parser_brew.set_defaults(cmd=brew)
+
+  # merge
+  parser_merge = subparsers.add_parser('merge',help="combine sharded brews")
+  parser_merge.add_argument('sharddirs', metavar='SHARDDIR', type=str,
+                      nargs='+',help='Output dirs of every shard')
+  parser_merge.add_argument('-d', metavar='DIR', type=str,
+                      default=DEFAULT_OUTPUT_DIR,dest='outputdir',
+                      help='Alternate output dir')
+  parser_merge.add_argument('-j','--jobs', metavar='N', type=int,
+                      default=1,dest='jobs',
+                      help='Number of compression threads')
+  parser_merge.add_argument('--export', metavar='DIR', type=str,
+                      default=None,dest='export',
+                      help='Copy only the files changed by this merge to DIR')
+  parser_merge.set_defaults(cmd=merge)
   
   # preview
   parser_preview = subparsers.add_parser('preview',help="preview site with embedded web server")
@@ -53,6 +115,10 @@ def run(argv):
   parser_clean = subparsers.add_parser('clean',help="remove site output")
   parser_clean.set_defaults(cmd=clean)
   
+  # precompile
+  parser_precompile = subparsers.add_parser('precompile',help="compile templates into the template cache")
+  parser_precompile.set_defaults(cmd=precompile)
+
   # inventory
   parser_inventory = subparsers.add_parser('inventory',help="list site contents")
   parser_inventory.set_defaults(cmd=inventory)
@@ -0,0 +1,161 @@
+"""
+micropress.manifest
+
+A persistent record of every output written by a brew. For each output
+file the manifest stores the inputs it was built from, the build key
+(a hash of the site configuration) and the output itself. Files are
+recorded as [mtime,size,md5] so that an unchanged file is recognized
+from a stat alone and only touched files need to be re-hashed.
+
+  {
+    "site/lorem.html": {
+      "key": "3f2a...",
+      "inputs": {"pages/lorem.markdown": [1302371201.0, 1876, "9e10..."]},
+      "output": [1302371204.0, 2411, "a0b1..."]
+    }
+  }
+"""
+
+import os
+import os.path
+import json
+import hashlib
+
+from micropress.util import save_json, filestamp, md5hex_for_file, debug
+from micropress.fs import snapshot
+
+class BuildManifest():
+  """
+  Manifest loaded from (and saved to) path. Entries recorded during a
+  brew are also collected in updates so that they can be shipped back
+  from worker processes and merged into the parent's manifest
+  """
+
+  def __init__(self,path):
+    self.path = path
+    self.entries = {}
+    self.updates = {}
+    if os.path.exists(path):
+      try:
+        self.entries = json.load(open(path))
+      except ValueError:
+        debug("Ignoring corrupt manifest %s" % path)
+
+  def get(self,dest):
+    "Return the entry recorded for an output file or None"
+    return self.entries.get(dest)
+
+  def _samefile(self,path,stamp):
+    "True if the file at path still matches a recorded [mtime,size,md5]"
+    if not snapshot.exists(path):
+      return False
+    current = filestamp(path)
+    if current == stamp[0:2]:
+      return True
+    # touched - compare contents
+    if md5hex_for_file(path) != stamp[2]:
+      return False
+    # unchanged, remember the new stamp so it is not hashed again
+    stamp[0:2] = current
+    return True
+
+  def explain(self,dest,key,inputs=None,values=None):
+    """
+    Return the reason dest needs to be rebuilt, or None if it is up to
+    date. If inputs is None the inputs recorded for dest are checked.
+    values is a dictionary of named values which dest may have been
+    recorded as depending upon
+    """
+    entry = self.entries.get(dest)
+    if entry is None:
+      return "not built before"
+    if entry['key'] != key:
+      return "configuration changed"
+    if inputs is not None and sorted(entry['inputs']) != sorted(inputs):
+      return "inputs changed"
+    for (name,value) in entry.get('values',{}).items():
+      if (values or {}).get(name) != value:
+        return "%s changed" % name
+    output = entry['output']
+    if not snapshot.exists(dest):
+      return "output missing"
+    if filestamp(dest) != output[0:2]:
+      return "output modified"
+    for src in sorted(entry['inputs']):
+      stamp = entry['inputs'][src]
+      before = stamp[0:2]
+      if not self._samefile(src,stamp):
+        return "%s changed" % src
+      if stamp[0:2] != before:
+        self.updates[dest] = entry
+    return None
+
+  def isfresh(self,dest,inputs,key,values=None):
+    """
+    True if dest was recorded as built from exactly inputs with the
+    same key and neither inputs or dest have changed since
+    """
+    return self.explain(dest,key,inputs,values) is None
+
+  def unchanged(self,dest,digest):
+    """
+    True if dest exists and already has the content with the (hex) md5
+    digest. Uses the recorded output hash when dest has not been
+    touched since it was recorded
+    """
+    if not snapshot.exists(dest):
+      return False
+    entry = self.entries.get(dest)
+    if entry and filestamp(dest) == entry['output'][0:2]:
+      return entry['output'][2] == digest
+    return md5hex_for_file(dest) == digest
+
+  def record(self,dest,inputs,key,digest=None,values=None):
+    """
+    Record that dest was built from inputs with key. digest is the md5
+    of dest, computed from the file if not supplied. values are named
+    values (other than files) that dest depends upon
+    """
+    stamps = {}
+    old = self.entries.get(dest)
+    for src in (inputs or []):
+      stamp = filestamp(src)
+      # avoid rehashing inputs that we have already seen unchanged
+      if old and old['inputs'].get(src,[None,None])[0:2] == stamp:
+        stamps[src] = old['inputs'][src]
+      else:
+        stamps[src] = stamp+[md5hex_for_file(src)]
+    if digest is None:
+      digest = md5hex_for_file(dest)
+    entry = dict(key=key,inputs=stamps,output=filestamp(dest)+[digest])
+    if values:
+      entry['values'] = values
+    self.entries[dest] = entry
+    self.updates[dest] = entry
+
+  def outputs(self,dir):
+    "Recorded output files within dir -> md5 (hex) of their contents"
+    prefix = os.path.join(dir,'')
+    return dict((dest,entry['output'][2])
+      for (dest,entry) in self.entries.items() if dest.startswith(prefix))
+
+  def forget(self,dest):
+    "Remove the entry of an output which no longer exists"
+    self.entries.pop(dest,None)
+    self.updates.pop(dest,None)
+
+  def merge(self,updates):
+    "Merge entries recorded by another process"
+    self.entries.update(updates)
+    self.updates.update(updates)
+
+  def save(self):
+    "Write the manifest to disk"
+    save_json(self.entries,self.path)
+    self.updates = {}
+
+def hash_values(*values):
+  "md5 (hex) of the JSON representation of values"
+  md5 = hashlib.md5()
+  md5.update(json.dumps(values,sort_keys=True,default=str))
+  return md5.hexdigest()
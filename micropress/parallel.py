@@ -0,0 +1,139 @@
+"""
+micropress.parallel
+
+Support for brewing a site across a pool of worker processes. Workers
+are forked from the brewing process, so each one inherits the loaded
+Site (config, extensions, templates and pages) and only the index of
+the page, or of the processor and names of the resources, to build is
+sent to it. Each processor's resources are split into a few batches
+per worker, so processors with buildall() still build many at once.
+Manifest entries recorded by a worker are sent back and merged into
+the parent's manifest.
+
+Resources are built first and pages second, exactly as in a serial
+brew. Hooks are fired by the parent process only.
+"""
+
+import os
+import multiprocessing
+from micropress.util import info, debug, publish_stats
+from micropress.fs import snapshot
+from micropress import profiling
+
+# state inherited by forked workers. Only valid inside parallel_brew()
+_site = None
+_pages = None
+
+# filesystem calls of this worker already reported to the parent
+_syscalls = 0
+
+# batches of each processor's resources per worker
+BATCHES_PER_WORKER = 4
+
+def _updates():
+  """
+  Manifest entries recorded, filesystem calls made, bytes published,
+  build times and profile events of this worker since the last task
+  """
+  global _syscalls
+  updates = _site.manifest.updates
+  _site.manifest.updates = {}
+  calls = snapshot.syscalls-_syscalls
+  _syscalls = snapshot.syscalls
+  published = dict(publish_stats)
+  for k in publish_stats:
+    publish_stats[k] = 0
+  costs = _site.costs
+  _site.costs = {}
+  events = profiling.profiler.drain() if profiling.profiler else []
+  return (updates,calls,published,costs,events)
+
+def _init_worker():
+  "Worker: forget profile events inherited from the parent"
+  if profiling.profiler:
+    profiling.profiler.drain()
+
+def _build_resources(task):
+  "Worker: build a batch of resources of a processor"
+  (ix,rscs,outputdir) = task
+  _site.build_resources(_site.processors[ix],rscs,outputdir)
+  return (os.getpid(),rscs,_updates())
+
+def _make_page(task):
+  "Worker: render a single page"
+  (ix,outputdir) = task
+  page = _pages[ix]
+  page.make(outputdir)
+  return (os.getpid(),[page.name+'.html'],_updates())
+
+def _batches(site,resources,outputdir,jobs):
+  """
+  Tasks building (resource,processor) pairs, each a batch of the
+  resources of one processor
+  """
+  byproc = []
+  for (rsc,proc) in resources:
+    if byproc and byproc[-1][0] is proc:
+      byproc[-1][1].append(rsc)
+    else:
+      byproc.append((proc,[rsc]))
+  tasks = []
+  for (proc,rscs) in byproc:
+    ix = site.processors.index(proc)
+    n = min(len(rscs),jobs*BATCHES_PER_WORKER)
+    # interleaved, as neighbouring resources tend to cost the same
+    tasks.extend((ix,rscs[i::n],outputdir) for i in range(n))
+  return tasks
+
+def _run(site,pool,func,tasks,total,progress,kind):
+  "Run tasks on the pool building total outputs, tallying them per worker"
+  done = 0
+  for (pid,names,(updates,calls,published,costs,events)) in pool.imap_unordered(func,tasks):
+    site.manifest.merge(updates)
+    site.costs.update(costs)
+    if events:
+      profiling.profiler.merge(events)
+    snapshot.syscalls += calls
+    for (k,n) in published.items():
+      publish_stats[k] += n
+    done += len(names)
+    counts = progress.setdefault(pid,{'resources':0,'pages':0})
+    counts[kind] += len(names)
+    debug("[worker %i] %s (%i/%i %s)" %
+      (pid,", ".join(names),done,total,kind))
+
+def parallel_brew(site,outputdir,jobs):
+  """
+  Build all resources and pages of site (or of the shard being
+  brewed) into outputdir using a pool of jobs worker processes
+  """
+  global _site, _pages, _syscalls
+  _site = site
+  _syscalls = snapshot.syscalls
+  (resources,_pages) = site.brewing()
+  # compile templates once, before forking, rather than in each worker
+  for name in sorted(set(p.template for p in _pages)):
+    site.load_template(name)
+  # pool must be created after the globals are set so workers inherit them
+  pool = multiprocessing.Pool(jobs,_init_worker)
+  progress = {}
+  try:
+    tasks = _batches(site,resources,outputdir,jobs)
+    with profiling.span('resources'):
+      _run(site,pool,_build_resources,tasks,len(resources),progress,
+        'resources')
+    pages = [(ix,outputdir) for ix in range(len(_pages))]
+    with profiling.span('pages'):
+      _run(site,pool,_make_page,pages,len(pages),progress,'pages')
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    _site = None
+    _pages = None
+  for (n,pid) in enumerate(sorted(progress)):
+    counts = progress[pid]
+    info("worker %i (pid %i): %i resources, %i pages" %
+      (n+1,pid,counts['resources'],counts['pages']))
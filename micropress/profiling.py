@@ -0,0 +1,127 @@
+"""
+micropress.profiling
+
+Timing of the phases of a brew: loading the config and extensions,
+scanning pages, each processor and hook, and rendering the markdown and
+template of each page. Enabled by brew --profile, which writes the
+timings as a Chrome trace (load it in chrome://tracing or Perfetto)
+and prints the slowest pages and templates.
+
+Instrumented code wraps work in span(), which does nothing unless a
+profiler has been enabled:
+
+  with span('loadpages'):
+    ...
+"""
+
+import os
+import json
+import time
+import thread
+
+# the enabled profiler, None when not profiling
+profiler = None
+
+class _Span():
+  "Records a complete event for the time spent within a with block"
+  def __init__(self,profiler,name,cat,args):
+    self.profiler = profiler
+    self.name = name
+    self.cat = cat
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self,type,value,tb):
+    end = time.time()
+    p = self.profiler
+    event = dict(name=self.name,cat=self.cat,ph='X',
+      ts=int((self.start-p.start)*1e6),dur=int((end-self.start)*1e6),
+      pid=os.getpid(),tid=thread.get_ident())
+    if self.args:
+      event['args'] = self.args
+    p.events.append(event)
+
+class _NoSpan():
+  def __enter__(self):
+    return self
+
+  def __exit__(self,type,value,tb):
+    pass
+
+_nospan = _NoSpan()
+
+class Profiler():
+  """
+  Collects trace events. Events of forked worker processes are sent
+  back to the parent with drain() and added with merge()
+  """
+  def __init__(self):
+    self.start = time.time()
+    self.events = []
+
+  def span(self,name,cat='brew',**args):
+    return _Span(self,name,cat,args)
+
+  def drain(self):
+    "Remove and return the events recorded so far"
+    events = self.events
+    self.events = []
+    return events
+
+  def merge(self,events):
+    self.events.extend(events)
+
+  def save(self,path):
+    "Write events as a Chrome trace to path"
+    f = open(path,'w')
+    try:
+      json.dump(dict(traceEvents=self.events,displayTimeUnit='ms'),f)
+    finally:
+      f.close()
+
+  def totals(self,cat):
+    "(total seconds,count,name) of events of a category, slowest first"
+    totals = {}
+    for e in self.events:
+      if e['cat'] == cat:
+        t = totals.setdefault(e['name'],[0,0])
+        t[0] += e['dur']
+        t[1] += 1
+    return sorted(((t/1e6,n,name) for (name,(t,n)) in totals.items()),
+      reverse=True)
+
+  def summary(self,n=10):
+    "Lines describing the n slowest of each kind of span"
+    lines = []
+    for (cat,title) in (('page','pages'),('template','templates'),
+        ('markdown','markdown'),('processor','processors'),
+        ('extension','extensions'),('hook','hooks')):
+      totals = self.totals(cat)
+      if not totals:
+        continue
+      lines.append("slowest %s:" % title)
+      for (secs,count,name) in totals[0:n]:
+        if count > 1:
+          lines.append("  %8.3fs  %s (%i times)" % (secs,name,count))
+        else:
+          lines.append("  %8.3fs  %s" % (secs,name))
+    return lines
+
+def enable():
+  "Start profiling, returning the profiler"
+  global profiler
+  profiler = Profiler()
+  return profiler
+
+def disable():
+  global profiler
+  profiler = None
+
+def span(name,cat='brew',**args):
+  "Context manager timing a block as an event, if profiling"
+  if profiler is None:
+    return _nospan
+  return profiler.span(name,cat,**args)
@@ -4,40 +4,188 @@ Generate an RSS feed for you site at feed.xml
 Configuration parameters:
   rss-title: title of RSS feed
   rss-description: description of RSS feed
+  rss-items: maximum number of items in a feed, newest first
+    (default 20)
+  rss-excerpt: describe items by an excerpt (the page's 'excerpt'
+    header or first paragraph) rather than the full page
+  rss-tag-feeds: also write a feed per tag at feeds/tag/<tag>.xml
+  rss-category-feeds: also write a feed per category at
+    feeds/category/<category>.xml
+
+Tags or categories which make the same path (C++ and C) are told apart
+by a short hash suffix, as for micropress.listing.
+
+Feeds are written item by item as the pages are rendered, and every
+feed is filled from a single walk over the pages newest first which
+stops once each feed is full, so the cost of a brew does not grow with
+the size of the archive.
 """
 
 from micropress import ResourceFactory
+from micropress.util import mkdir, slug, slugs
+from xml.sax.saxutils import XMLGenerator
 import os.path
-import datetime
-import PyRSS2Gen
 
-def feed_link(site):
-  return """<link href="%s" rel="alternate" type="application/rss+xml" title="%s" />""" % (site.resource_href('feed.xml'),site.config.get('rss-title','RSS Feed'))
-  
+DEFAULT_ITEMS = 20
+
+def feed_link(site,tag=None,category=None):
+  title = site.config.get('rss-title','RSS Feed')
+  if tag is not None or category is not None:
+    title = "%s: %s" % (title,tag if tag is not None else category)
+  name = site.resource_processor('feed.xml').feed_name(tag,category)
+  return """<link href="%s" rel="alternate" type="application/rss+xml" title="%s" />""" % (site.resource_href(name),title)
+
+def rfc822(dt):
+  "Format a datetime as an RFC 822 date as required by RSS"
+  return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (
+    ["Mon","Tue","Wed","Thu","Fri","Sat","Sun"][dt.weekday()],dt.day,
+    ["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov",
+     "Dec"][dt.month-1],dt.year,dt.hour,dt.minute,dt.second)
+
+def excerpt(page):
+  "Short description of a page: its excerpt header or first paragraph"
+  if 'excerpt' in page.header:
+    return page.header['excerpt']
+  html = page.content()
+  end = html.find('</p>')
+  if end >= 0:
+    return html[0:end+4]
+  return html
+
+class FeedWriter():
+  """
+  Writes an RSS 2.0 document to a file, an item at a time
+  """
+  def __init__(self,out,encoding='utf-8'):
+    self.xml = XMLGenerator(out,encoding)
+
+  def _element(self,name,text,attrs={}):
+    self.xml.startElement(name,attrs)
+    if text is not None:
+      self.xml.characters(text)
+    self.xml.endElement(name)
+
+  def start(self,title,link,description,date=None):
+    self.xml.startDocument()
+    self.xml.startElement('rss',{'version':'2.0'})
+    self.xml.startElement('channel',{})
+    self._element('title',title or '')
+    self._element('link',link)
+    self._element('description',description or '')
+    if date is not None:
+      self._element('lastBuildDate',rfc822(date))
+    self._element('generator','micropress')
+
+  def item(self,title,link,description,date):
+    self.xml.startElement('item',{})
+    self._element('title',title)
+    self._element('link',link)
+    self._element('description',description)
+    self._element('guid',link,{'isPermaLink':'true'})
+    self._element('pubDate',rfc822(date))
+    self.xml.endElement('item')
+
+  def end(self):
+    self.xml.endElement('channel')
+    self.xml.endElement('rss')
+    self.xml.endDocument()
+
 class FeedProcessor(ResourceFactory):
-    
+  """
+  Publishes the site feed and optionally a feed for each tag and
+  category
+  """
   def __init__(self,site):
     ResourceFactory.__init__(self,site,'feed.xml')
-    
-  def _dobuild(self,out):
+
+  def slugs(self):
+    "(tag slugs,category slugs) of the site. Computed once per brew"
+    return self.per_brew('slugs',lambda: (
+      slugs(self.site.index.tags(),'tags'),
+      slugs(self.site.index.categories(),'categories')))
+
+  def feed_name(self,tag=None,category=None):
+    "Resource name of the site feed, or of the feed of a tag or category"
+    (tagslugs,categoryslugs) = self.slugs()
+    if tag is not None:
+      return 'feeds/tag/%s.xml' % tagslugs.get(tag,slug(tag))
+    if category is not None:
+      return 'feeds/category/%s.xml' % \
+        categoryslugs.get(category,slug(category))
+    return self.name
+
+  def feeds(self):
+    "Resource name -> (tag,category) of every feed"
+    config = self.site.config
+    feeds = {self.name: (None,None)}
+    if config.get('rss-tag-feeds'):
+      for tag in self.site.index.tags():
+        feeds[self.feed_name(tag=tag)] = (tag,None)
+    if config.get('rss-category-feeds'):
+      for category in self.site.index.categories():
+        feeds[self.feed_name(category=category)] = (None,category)
+    return feeds
+
+  def resources(self):
+    return sorted(self.feeds())
+
+  def accept(self,rsc):
+    return rsc in self.feeds()
+
+  def select(self,rscs):
+    """
+    Pages of each feed in rscs, newest first, from a single walk over
+    the pages
+    """
     site = self.site
-    rss = PyRSS2Gen.RSS2(
-        # TODO: are title/description required fields?
-        title = site.config.get('rss-title'),
-        link = site.url(),
-        description = site.config.get('rss-description'),
-        lastBuildDate = datetime.datetime.utcnow())
-    for p in site.querypages():
-      url = p.url()
-      rss.items.append( PyRSS2Gen.RSSItem(
-         title = p.title,
-         link = url, 
-         description = p.content(),
-         guid = PyRSS2Gen.Guid(url),
-         pubDate = p.date_created()))
-    # TODO: encoding
-    rss.write_xml(open(out, "w"))
-    
+    maxitems = site.config.get('rss-items',DEFAULT_ITEMS)
+    feeds = self.feeds()
+    # (tag,category) -> pages, for the feeds still being filled
+    selected = dict((feeds[rsc],[]) for rsc in rscs)
+    filling = len(selected)
+    for name in site.index.ordered('date_created'):
+      if not filling:
+        break
+      page = site.index.pages[name]
+      keys = [(None,None)]
+      if page.category is not None:
+        keys.append((None,page.category))
+      keys.extend((tag,None) for tag in page.tags)
+      for key in keys:
+        items = selected.get(key)
+        if items is not None and (maxitems is None or len(items) < maxitems):
+          items.append(page)
+          if len(items) == maxitems:
+            filling -= 1
+    return dict((rsc,selected[feeds[rsc]]) for rsc in rscs)
+
+  def build(self,rsc,outdir):
+    self.buildall([rsc],outdir)
+
+  def buildall(self,rscs,outdir):
+    site = self.site
+    config = site.config
+    describe = excerpt if config.get('rss-excerpt') else (lambda p: p.content())
+    feeds = self.feeds()
+    for (rsc,pages) in sorted(self.select(rscs).items()):
+      (tag,category) = feeds[rsc]
+      title = config.get('rss-title')
+      if tag is not None or category is not None:
+        title = "%s: %s" % (title or '',tag if tag is not None else category)
+      dest = os.path.join(outdir,rsc)
+      mkdir(os.path.dirname(dest))
+      out = open(dest,'wb')
+      try:
+        writer = FeedWriter(out,site.encoding)
+        # date of the newest item, so unchanged feeds are identical
+        writer.start(title,site.url(),config.get('rss-description'),
+          pages[0].date_created() if pages else None)
+        for p in pages:
+          writer.item(p.title,p.url(),describe(p),p.date_created())
+        writer.end()
+      finally:
+        out.close()
+
 def extend_micropress(site):
   site.ext['feed_link'] = feed_link
   site.processors.append(FeedProcessor(site))
@@ -0,0 +1,152 @@
+"""
+micropress.shard
+
+Splits a brew across several independent invocations (for example on
+different CI runners), each building a share of the pages and
+resources, which are then merged into one site:
+
+  micropress brew --shard 1/3 -d shard1
+  micropress brew --shard 2/3 -d shard2
+  micropress brew --shard 3/3 -d shard3
+  micropress merge shard1 shard2 shard3
+
+Pages and resources are assigned by placing the most expensive first
+on the least loaded shard, using the time each took to build in the
+last full brew or merge (recorded in .micropress/costs.json). Those
+with no recorded time are assumed to take the average. The assignment
+depends only on the site and the costs, so every shard must be brewed
+with the same costs file, for example restored from a cache saved
+after the merge.
+
+Site-wide resources (those of a ResourceFactory, such as the sitemap,
+feeds and listing pages) depend on every page, so shards do not build
+them. A shard writes the manifest entries and build times of its
+outputs to .micropress-shard.json in its output directory. merge
+copies the outputs of every shard into the output directory, adopting
+their manifest entries, then builds the site-wide resources once.
+"""
+
+import os
+import os.path
+import json
+import heapq
+
+from micropress import CACHE_DIR, ResourceFactory
+from micropress.util import info, debug, mkdir, filestamp, publish, save_json
+from micropress.fs import snapshot
+
+COSTS_PATH = os.path.join(CACHE_DIR,'costs.json')
+SHARD_RECORD = '.micropress-shard.json'
+
+def parse(spec):
+  "(i,n) of a shard given as i/n, numbered from 1"
+  try:
+    (i,n) = [int(s) for s in spec.split('/')]
+  except ValueError:
+    raise ValueError("shard must be given as i/n, not %s" % spec)
+  if not 1 <= i <= n:
+    raise ValueError("no shard %i of %i" % (i,n))
+  return (i,n)
+
+def load_costs(path=COSTS_PATH):
+  "Output name -> seconds it took to build"
+  if not os.path.exists(path):
+    return {}
+  try:
+    return json.load(open(path))
+  except ValueError:
+    debug("Ignoring corrupt costs %s" % path)
+    return {}
+
+def save_costs(costs,path=COSTS_PATH):
+  save_json(costs,path,sort_keys=True)
+
+def assign(names,costs,n):
+  "name -> shard (1..n) of each name, balancing the total cost of shards"
+  known = [costs[name] for name in names if name in costs]
+  default = sum(known)/len(known) if known else 1.0
+  # most expensive first, ties broken by name
+  weighted = sorted((-costs.get(name,default),name) for name in names)
+  # (load,shard) of every shard, least loaded (then lowest) first
+  loads = [(0.0,i) for i in range(1,n+1)]
+  assignment = {}
+  for (negcost,name) in weighted:
+    (load,i) = heapq.heappop(loads)
+    assignment[name] = i
+    heapq.heappush(loads,(load-negcost,i))
+  return assignment
+
+def share(site,resources,pages,shard):
+  """
+  The (resources,pages) of a shard, given as (i,n), from all the
+  (resource,processor) pairs and pages of a brew
+  """
+  (i,n) = shard
+  resources = [(rsc,p) for (rsc,p) in resources
+    if not isinstance(p,ResourceFactory)]
+  names = [rsc for (rsc,p) in resources]+[p.name+'.html' for p in pages]
+  assignment = assign(names,load_costs(),n)
+  return ([(rsc,p) for (rsc,p) in resources if assignment[rsc] == i],
+    [p for p in pages if assignment[p.name+'.html'] == i])
+
+def write_record(site,outputdir,shard,outputs):
+  """
+  Write the manifest entries and build times of the outputs of a shard
+  to its output directory
+  """
+  prefix = os.path.join(outputdir,'')
+  history = load_costs()
+  entries = {}
+  costs = {}
+  for dest in sorted(outputs):
+    entry = site.manifest.get(dest)
+    if entry is None:
+      continue
+    rel = dest[len(prefix):]
+    entries[rel] = entry
+    cost = site.costs.get(rel,history.get(rel))
+    if cost is not None:
+      costs[rel] = cost
+  record = dict(shard=list(shard),key=site.buildkey,outputs=entries,
+    costs=costs)
+  save_json(record,os.path.join(outputdir,SHARD_RECORD),sort_keys=True)
+
+def load_records(dirs):
+  "Records of the shards brewed into dirs, which must be all shards of a brew"
+  records = [json.load(open(os.path.join(dir,SHARD_RECORD))) for dir in dirs]
+  counts = set(record['shard'][1] for record in records)
+  numbers = sorted(record['shard'][0] for record in records)
+  if len(counts) != 1 or numbers != range(1,max(counts)+1):
+    raise Exception("shards %s are not every shard of one brew" %
+      ", ".join("%i/%i" % tuple(record['shard']) for record in records))
+  return records
+
+def merge(site,outputdir,dirs):
+  """
+  Copy the outputs of the shards brewed into dirs to outputdir,
+  adopting their manifest entries and build times. Returns the paths
+  of the outputs
+  """
+  manifest = site.manifest
+  merged = set()
+  for (dir,record) in zip(dirs,load_records(dirs)):
+    if record['key'] != site.buildkey:
+      info("warning: shard %i/%i was brewed with a different configuration" %
+        tuple(record['shard']))
+    copied = 0
+    for (rel,entry) in sorted(record['outputs'].items()):
+      dest = os.path.join(outputdir,rel)
+      digest = entry['output'][2]
+      if not manifest.unchanged(dest,digest):
+        mkdir(os.path.dirname(dest))
+        # not hardlinked, a later brew would write through to the shard
+        publish(os.path.join(dir,rel),dest,'reflink')
+        snapshot.forget(dest)
+        copied += 1
+      entry = dict(entry,output=filestamp(dest)+[digest])
+      manifest.merge({dest:entry})
+      merged.add(dest)
+    site.costs.update(record['costs'])
+    info("merged %i outputs of shard %i/%i from %s (%i copied)" %
+      (len(record['outputs']),record['shard'][0],record['shard'][1],dir,copied))
+  return merged
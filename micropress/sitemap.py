@@ -1,54 +1,159 @@
 """
 Generates a sitemap feed for you site at sitemap.xml
+
+Configuration parameters:
+  sitemap-shard-size: maximum number of urls in a sitemap file
+    (default 50000, the limit of the protocol)
+  sitemap-resources: also list static resources. true for all of
+    them, or a list of extensions, e.g. [.pdf]
+
+A site with more urls than fit in one file is written as shards
+sitemap-1.xml, sitemap-2.xml, ... listed by a sitemap index at
+sitemap.xml. Urls are sharded in order of page name, then resource
+name. Each shard is recorded in the build manifest against the urls
+it lists, so a shard whose pages did not change is not rewritten.
 """
 
 from micropress import ResourceFactory
-from micropress.util import exectool
+from micropress.manifest import hash_values
+from micropress.util import mkdir
+from micropress.fs import snapshot
+from xml.sax.saxutils import XMLGenerator
+from datetime import datetime
 import os.path
-import xml.etree.ElementTree as ET
 
 # see http://www.sitemaps.org/protocol.php
+XMLNS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+SHARD_SIZE = 50000
 
-def indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+class SitemapWriter():
+  """
+  Writes a urlset or sitemapindex document to a file, an entry at a
+  time
+  """
+  def __init__(self,out,root):
+    self.root = root
+    self.xml = XMLGenerator(out,'utf-8')
+    self.xml.startDocument()
+    self.xml.startElement(root,{'xmlns':XMLNS})
+
+  def entry(self,name,values):
+    "Write a url (or sitemap) element with child elements from values"
+    xml = self.xml
+    xml.ignorableWhitespace("\n  ")
+    xml.startElement(name,{})
+    for (key,value) in values:
+      if value is None:
+        continue
+      xml.ignorableWhitespace("\n    ")
+      xml.startElement(key,{})
+      xml.characters("%s" % value)
+      xml.endElement(key)
+    xml.ignorableWhitespace("\n  ")
+    xml.endElement(name)
+
+  def close(self):
+    self.xml.ignorableWhitespace("\n")
+    self.xml.endElement(self.root)
+    self.xml.endDocument()
 
-def subel(elem,values):
-  for (key,value) in values.items():
-    ET.SubElement(elem, key).text = value
-            
 class SitemapProcessor(ResourceFactory):
-    
+
   def __init__(self,site):
     ResourceFactory.__init__(self,site,'sitemap.xml')
-    
-  def _dobuild(self,out):
+
+  def _resources(self):
+    "(resource,processor) of the static resources listed"
+    option = self.site.config.get('sitemap-resources')
+    if not option:
+      return []
+    seen = set()
+    listed = []
+    for proc in self.others():
+      for rsc in proc.resources():
+        if rsc in seen:
+          continue
+        seen.add(rsc)
+        if option is True or os.path.splitext(rsc)[1] in option:
+          listed.append((rsc,proc))
+    return sorted(listed)
+
+  def urls(self):
+    "Iterate over the (loc,lastmod,changefreq,priority) to list"
+    site = self.site
+    index = site.index
+    for name in index.ordered():
+      p = index.pages[name]
+      # TODO: validate changefreq/priority
+      yield (p.url(),p.date_modified('%Y-%m-%d'),
+        p.header.get('sitemap-changefreq'),p.header.get('sitemap-priority'))
+    for (rsc,proc) in self._resources():
+      lastmod = None
+      if hasattr(proc,'path_from_resource'):
+        path = proc.path_from_resource(rsc)
+        if snapshot.exists(path):
+          lastmod = datetime.fromtimestamp(
+            snapshot.getmtime(path)).strftime('%Y-%m-%d')
+      yield (site.url()+rsc,lastmod,None,None)
+
+  def shards(self):
+    """
+    Resource name -> urls of each sitemap file, or of sitemap.xml
+    alone if all urls fit in one file. Computed once per brew
+    """
+    return self.per_brew('shards',self._shards)
+
+  def _shards(self):
+    size = self.site.config.get('sitemap-shard-size',SHARD_SIZE)
+    urls = list(self.urls())
+    shards = {}
+    if len(urls) <= size:
+      shards[self.name] = urls
+    else:
+      for n in range(0,(len(urls)+size-1)/size):
+        shards['sitemap-%i.xml' % (n+1)] = urls[n*size:(n+1)*size]
+    return shards
+
+  def index(self):
+    "(shard,lastmod) of each shard listed by the sitemap index"
+    shards = self.shards()
+    names = sorted((n for n in shards if n != self.name),
+      key=lambda n: int(n[8:-4]))
+    return [(n,max(u[1] for u in shards[n])) for n in names]
+
+  def resources(self):
+    return [self.name]+[n for (n,lastmod) in self.index()]
+
+  def accept(self,rsc):
+    return rsc in self.resources()
+
+  def values(self,rsc):
+    "The urls listed by a sitemap file, which it is built from"
+    shards = self.shards()
+    if rsc in shards:
+      return dict(urls=hash_values(shards[rsc]))
+    return dict(urls=hash_values(self.index()))
+
+  def build(self,rsc,outdir):
     """create the target resource in the output directory"""
-    root = ET.Element("urlset",dict(xmlns='http://www.sitemaps.org/schemas/sitemap/0.9'))
-    for p in self.site.querypages():
-      attr = dict(loc=p.url(),lastmod=p.date_modified('%Y-%m-%d'))
-      if 'sitemap-changefreq' in p.header:
-        # TODO: validate input
-        attr['changefreq'] = p.header['sitemap-changefreq']
-      if 'sitemap-priority' in p.header:
-        # TODO: validate input
-        attr['priority'] = p.header['sitemap-priority']
-      subel(ET.SubElement(root, "url"),attr)
-    indent(root)
-    tree = ET.ElementTree(root)
-    tree.write(out)
-    
-    
+    shards = self.shards()
+    dest = os.path.join(outdir,rsc)
+    mkdir(os.path.dirname(dest))
+    out = open(dest,'wb')
+    try:
+      if rsc in shards:
+        writer = SitemapWriter(out,'urlset')
+        for (loc,lastmod,changefreq,priority) in shards[rsc]:
+          writer.entry('url',[('loc',loc),('lastmod',lastmod),
+            ('changefreq',changefreq),('priority',priority)])
+      else:
+        writer = SitemapWriter(out,'sitemapindex')
+        for (shard,lastmod) in self.index():
+          writer.entry('sitemap',[('loc',self.site.url()+shard),
+            ('lastmod',lastmod)])
+      writer.close()
+    finally:
+      out.close()
+
 def extend_micropress(site):
   site.processors.append(SitemapProcessor(site))
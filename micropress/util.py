@@ -6,10 +6,19 @@ An assortment of utility routines for working within micropress
 
 import os
 import os.path
+import re
+import json
+import errno
+import shutil
 import hashlib
 import subprocess
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 
+from micropress.fs import snapshot
+
 # logging
 # TODO: remove camel case
 debug_level = 0
@@ -32,7 +41,7 @@ def trace(msg):
 def listfiles(dir):
   "List all files (recursively) under directory"
   # TODO: implement a common list of exclusions
-  for root, dirs, files in os.walk(dir):
+  for root, dirs, files in snapshot.walk(dir):
     # do not walk directories with dot prefix
     dirs[:] = [d for d in dirs if d[0] != '.']
     for f in files:
@@ -40,14 +49,40 @@ def listfiles(dir):
       path = os.path.join(root,f)[len(dir)+1:]
       yield path
 
+def slug(name):
+  "Name made safe for use in a path or url"
+  return re.sub(r'[^\w.-]+','-',name,flags=re.U).strip('-') or '-'
+
+def slugs(names,what='names'):
+  """
+  Name -> slug of each of names. Names which share a slug (C++ and C)
+  are told apart by a short hash of the name, except one which is its
+  own slug
+  """
+  byslug = {}
+  for name in names:
+    byslug.setdefault(slug(name),[]).append(name)
+  result = {}
+  for (s,group) in byslug.items():
+    if len(group) > 1:
+      info("warning: %s %s share the slug %s" %
+        (what,", ".join(sorted(group)),s))
+    for name in group:
+      if len(group) > 1 and name != s:
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+        result[name] = "%s-%s" % (s,digest[:6])
+      else:
+        result[name] = s
+  return result
+
 def isuptodate(dest,*sources):
   """
   Check a source file for modification against a numer of other files
   """
-  if not os.path.exists(dest):
+  if not snapshot.exists(dest):
    return False
   for src in sources:
-   if os.path.getmtime(src) > os.path.getmtime(dest):
+   if snapshot.getmtime(src) > snapshot.getmtime(dest):
      return False
   return True
 
@@ -62,11 +97,139 @@ def md5_for_file(filename, block_size=2**20):
            break
        md5.update(data)
    return md5.digest()
+
+def md5hex_for_files(*filenames):
+  "md5 hash (hex) of the contents of a number of files, in order"
+  md5 = hashlib.md5()
+  for filename in filenames:
+    md5.update(filename)
+    md5.update(md5_for_file(filename))
+  return md5.hexdigest()
+
+def md5hex_for_file(filename):
+  "get the md5 hash of a file as a hex string"
+  return md5_for_file(filename).encode('hex')
+
+def filestamp(path):
+  "(mtime,size) of a file, used to detect changes without reading it"
+  st = snapshot.stat(path)
+  if st is None:
+    raise OSError(2,"No such file or directory",path)
+  return [st.st_mtime,st.st_size]
      
 def mkdir(dir):
  "Create a directory if it does not exist"
- if not os.path.exists(dir):
-   os.makedirs(dir)
+ if not snapshot.exists(dir):
+   if not os.path.exists(dir):
+     os.makedirs(dir)
+   snapshot.forget(dir)
+
+def save_json(value,path,**options):
+  """
+  Write value as JSON to path, through a temporary file renamed into
+  place so that readers never see a partial file. options are passed
+  to json.dump
+  """
+  mkdir(os.path.dirname(path))
+  tmp = path+'.tmp'
+  f = open(tmp,'w')
+  try:
+    json.dump(value,f,**options)
+  finally:
+    f.close()
+  os.rename(tmp,path)
+
+# Publishing files into the output directory. Large static resources
+# need not be copied through userspace:
+#   hardlink - link the output to the source (shares the inode)
+#   reflink - copy-on-write clone, on filesystems that support it
+#   copy - copy_file_range() in the kernel, falling back to copyfile
+#   auto - reflink if supported, otherwise copy
+PUBLISH_STRATEGIES = ('auto','reflink','hardlink','copy')
+# strategy used when a processor does not specify one
+publish_strategy = 'auto'
+# bytes published by copying vs linking/cloning
+publish_stats = {'copied':0,'linked':0}
+
+FICLONE = 0x40049409
+
+def _reflink(src,dest):
+  "Clone src to dest (copy on write). Raises IOError if unsupported"
+  import fcntl
+  s = open(src,'rb')
+  try:
+    d = open(dest,'wb')
+    try:
+      fcntl.ioctl(d.fileno(),FICLONE,s.fileno())
+    finally:
+      d.close()
+  except IOError:
+    os.remove(dest)
+    raise
+  finally:
+    s.close()
+
+_libc = None
+
+def _kernelcopy(src,dest,size):
+  "Copy src to dest with copy_file_range(). Raises OSError if unsupported"
+  global _libc
+  if _libc is None:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    _libc.copy_file_range.restype = ctypes.c_ssize_t
+    _libc.copy_file_range.argtypes = [ctypes.c_int,ctypes.c_void_p,
+      ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_uint]
+  import ctypes
+  s = open(src,'rb')
+  try:
+    d = open(dest,'wb')
+    try:
+      remaining = size
+      while remaining > 0:
+        n = _libc.copy_file_range(s.fileno(),None,d.fileno(),None,remaining,0)
+        if n < 0:
+          e = ctypes.get_errno()
+          raise OSError(e,os.strerror(e))
+        if n == 0:
+          break
+        remaining -= n
+    finally:
+      d.close()
+  finally:
+    s.close()
+
+def publish(src,dest,strategy=None):
+  """
+  Create dest with the contents of src using a publish strategy
+  (default publish_strategy), falling back to copying if the strategy
+  is not supported. Returns 'linked' or 'copied'
+  """
+  strategy = strategy or publish_strategy
+  if strategy not in PUBLISH_STRATEGIES:
+    raise Exception("Unknown publish strategy %s" % strategy)
+  size = os.path.getsize(src)
+  # never write through an existing (hard linked) output
+  if os.path.lexists(dest):
+    os.remove(dest)
+  how = 'copied'
+  try:
+    if strategy == 'hardlink':
+      os.link(src,dest)
+      how = 'linked'
+    elif strategy in ('reflink','auto'):
+      _reflink(src,dest)
+      how = 'linked'
+    else:
+      raise IOError(errno.EOPNOTSUPP,"copy")
+  except (IOError,OSError), e:
+    trace("%s unavailable for %s (%s)" % (strategy,dest,e))
+    try:
+      _kernelcopy(src,dest,size)
+    except (IOError,OSError,AttributeError):
+      shutil.copyfile(src,dest)
+  publish_stats[how] += size
+  return how
 
 def parse_datetime(value):
  """
@@ -80,13 +243,77 @@ def parse_datetime(value):
 # Good resource on subprocess
 # http://www.doughellmann.com/PyMOTW/subprocess/index.html
 
-def exectool(cmd,*args):
-   """Run a program - check for valid return"""
+# seconds after which a tool is killed, by tool name (None for no limit)
+tool_timeouts = {}
+# maximum number of tools run at once by exectools (None for cpu count)
+tool_jobs = None
+
+def exectool(cmd,*args,**kwargs):
+   """
+   Run a program - check for valid return. The program is killed if
+   it runs longer than the timeout keyword argument, which defaults to
+   tool_timeouts[cmd]
+   """
+   timeout = kwargs.get('timeout',tool_timeouts.get(cmd))
    proc = subprocess.Popen((cmd,)+args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-   output = proc.communicate()[0]
+   timer = None
+   # set by the timer when it kills the program
+   killed = threading.Event()
+   def kill():
+     killed.set()
+     proc.kill()
+   if timeout:
+     timer = threading.Timer(timeout,kill)
+     timer.start()
+   try:
+     output = proc.communicate()[0]
+   finally:
+     if timer:
+       timer.cancel()
    # print output if we have anything
    if output:
      print cmd+": "+output
+   if killed.is_set():
+     raise Exception("%s timed out after %s seconds" % (cmd,timeout))
    # raise error if failed!
    if proc.returncode != 0:
-     raise Exception("%s returned err code %i" % (cmd,proc.returncode))
\ No newline at end of file
+     raise Exception("%s returned err code %i" % (cmd,proc.returncode))
+
+_toolversions = {}
+
+def toolversion(cmd):
+   "Version string reported by `cmd --version`, memoized"
+   if cmd not in _toolversions:
+     try:
+       proc = subprocess.Popen((cmd,'--version'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+       _toolversions[cmd] = proc.communicate()[0].strip()
+     except OSError:
+       _toolversions[cmd] = 'unknown'
+   return _toolversions[cmd]
+
+def exectools(calls,jobs=None):
+   """
+   Run a number of programs concurrently, at most jobs (default
+   tool_jobs or the number of cpus) at a time. Each call is a tuple
+   of program and arguments, as passed to exectool. Raises the first
+   failure after all programs have finished
+   """
+   calls = list(calls)
+   jobs = jobs or tool_jobs or multiprocessing.cpu_count()
+   if len(calls) <= 1 or jobs == 1:
+     for call in calls:
+       exectool(*call)
+     return
+   def run(call):
+     try:
+       exectool(*call)
+     except Exception, e:
+       return e
+   pool = ThreadPool(min(jobs,len(calls)))
+   try:
+     errors = [e for e in pool.map(run,calls) if e is not None]
+   finally:
+     pool.close()
+     pool.join()
+   if errors:
+     raise errors[0]
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+micropress.watch
+
+Watches the files of a site for changes so that the preview server can
+keep its Site current without rescanning everything on each request.
+
+On Linux changes are reported by inotify. Elsewhere (or if inotify is
+unavailable) the tree is polled for changed mtimes. Either way a
+background thread invokes a callback with the set of changed paths.
+"""
+
+import os
+import os.path
+import sys
+import struct
+import select
+import threading
+import time
+import ctypes
+import ctypes.util
+
+from micropress.util import debug
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_IGNORED = 0x00008000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+def _walkdirs(top,exclude):
+  "All directories under top, skipping dot prefixed and excluded ones"
+  for root, dirs, files in os.walk(top):
+    dirs[:] = [d for d in dirs if d[0] != '.'
+      and os.path.normpath(os.path.join(root,d)) not in exclude]
+    yield os.path.normpath(root)
+
+class Watcher():
+  """
+  Base class for watchers. Watches top recursively, ignoring dot
+  prefixed directories and those in exclude, and calls callback with
+  a set of changed paths (relative to top, as os.path.join(top,...))
+  """
+  def __init__(self,top,callback,exclude=()):
+    self.top = top
+    self.callback = callback
+    self.exclude = set(os.path.normpath(e) for e in exclude)
+    self._stop = False
+    self._thread = None
+
+  def _ignored(self,path):
+    parts = os.path.normpath(path).split(os.sep)
+    for (ix,part) in enumerate(parts):
+      if part[0:1] == '.' and part not in ('.','..'):
+        return True
+      if os.path.join(*parts[0:ix+1]) in self.exclude:
+        return True
+    return False
+
+  def start(self):
+    "Start watching in a background (daemon) thread"
+    self._thread = threading.Thread(target=self._run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop = True
+
+  def _run(self):
+    while not self._stop:
+      changes = self.poll(1.0)
+      if changes:
+        debug("changed: %s" % ", ".join(sorted(changes)))
+        self.callback(changes)
+
+class PollingWatcher(Watcher):
+  """
+  Detects changes by comparing the (mtime,size) of every file with
+  that seen on the previous poll
+  """
+  def __init__(self,top,callback,exclude=(),interval=1.0):
+    Watcher.__init__(self,top,callback,exclude)
+    self.interval = interval
+    self._stamps = self._scan()
+
+  def _scan(self):
+    stamps = {}
+    for dir in _walkdirs(self.top,self.exclude):
+      for name in os.listdir(dir):
+        path = os.path.join(dir,name)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        stamps[path] = (st.st_mtime,st.st_size)
+    return stamps
+
+  def poll(self,timeout=None):
+    "Return the set of paths changed since the last poll"
+    if timeout:
+      time.sleep(min(timeout,self.interval))
+    stamps = self._scan()
+    changes = set()
+    for (path,stamp) in stamps.items():
+      if self._stamps.get(path) != stamp:
+        changes.add(path)
+    for path in self._stamps:
+      if path not in stamps:
+        changes.add(path)
+    self._stamps = stamps
+    return changes
+
+class InotifyWatcher(Watcher):
+  "Detects changes using Linux inotify"
+  def __init__(self,top,callback,exclude=()):
+    Watcher.__init__(self,top,callback,exclude)
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    self._fd = self._libc.inotify_init()
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(),"inotify_init failed")
+    self._dirs = {}
+    for dir in _walkdirs(top,self.exclude):
+      self._watch(dir)
+
+  def _watch(self,dir):
+    wd = self._libc.inotify_add_watch(self._fd,dir,WATCH_MASK)
+    if wd >= 0:
+      self._dirs[wd] = dir
+
+  def poll(self,timeout=None):
+    "Wait up to timeout seconds and return the set of changed paths"
+    changes = set()
+    (ready,w,x) = select.select([self._fd],[],[],timeout)
+    while ready:
+      data = os.read(self._fd,65536)
+      offset = 0
+      while offset < len(data):
+        (wd,mask,cookie,length) = EVENT_HEADER.unpack_from(data,offset)
+        offset += EVENT_HEADER.size
+        name = data[offset:offset+length].rstrip('\0')
+        offset += length
+        dir = self._dirs.get(wd)
+        if dir is None or mask & IN_IGNORED:
+          self._dirs.pop(wd,None)
+          continue
+        path = os.path.join(dir,name) if name else dir
+        if self._ignored(path):
+          continue
+        changes.add(path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+          for sub in _walkdirs(path,self.exclude):
+            self._watch(sub)
+            changes.update(os.path.join(sub,f) for f in os.listdir(sub))
+      # collect events arriving in a burst together
+      (ready,w,x) = select.select([self._fd],[],[],0.05)
+    return changes
+
+def watcher(top,callback,exclude=()):
+  "Create the best available watcher for this platform"
+  if sys.platform.startswith('linux'):
+    try:
+      return InotifyWatcher(top,callback,exclude)
+    except (OSError,AttributeError), e:
+      debug("inotify unavailable (%s), polling for changes" % e)
+  return PollingWatcher(top,callback,exclude)
@@ -9,50 +9,126 @@ from cherrypy import wsgiserver
 import cherrypy
 from functools import partial
 import os.path
-from micropress import DEFAULT_PREVIEW_DIR
+import threading
+import hashlib
+import gzip
+from cStringIO import StringIO
+from micropress import DEFAULT_PREVIEW_DIR, DEFAULT_OUTPUT_DIR
 from micropress.util import mkdir
+from micropress.watch import watcher
+from micropress.cache import LRU
 import mimetypes
 
 mimetypes.init()
 
+# guards the site against concurrent requests and watcher updates
+_lock = threading.RLock()
+
+# rendered responses keyed by (resource,site generation), while the
+# site is kept current by a watcher
+_responses = LRU(256)
+
+class Response():
+  """
+  A rendered resource held in the response cache, along with its
+  gzipped variant (compressed on first use). Each variant has its own
+  strong ETag
+  """
+  def __init__(self,name,body):
+    self.body = body
+    self.digest = hashlib.md5(body).hexdigest()
+    self.content_type = content_type(name)
+    self._gzipped = None
+
+  def etag(self,gzipped=False):
+    if gzipped:
+      return '"%s-gz"' % self.digest
+    return '"%s"' % self.digest
+
+  def gzipped(self):
+    if self._gzipped is None:
+      buf = StringIO()
+      f = gzip.GzipFile(mode='wb',fileobj=buf,mtime=0)
+      f.write(self.body)
+      f.close()
+      self._gzipped = buf.getvalue()
+    return self._gzipped
+
+def content_type(name):
+  "Content type of a resource, application/octet-stream if not known"
+  (path,ext) = os.path.splitext(name)
+  return mimetypes.types_map.get(ext.lower(),'application/octet-stream')
+
+def sync(site,paths):
+  "Apply changes reported by the watcher to the site"
+  with _lock:
+    site.sync(paths)
+
 def build(site,name):
 #         print "BUILD %s%s" % (path,ext)
- site.refresh()
- for proc in site.processors:
-   if proc.accept(name):
-     proc.build(name,DEFAULT_PREVIEW_DIR)
-     return
+ proc = site.resource_processor(name)
+ if proc:
+   proc.build(name,DEFAULT_PREVIEW_DIR)
+   return
  (path,ext) = os.path.splitext(name)   
  if ext == '.html':
    p = site.page(path)
    if p:
      p.make(DEFAULT_PREVIEW_DIR)
    
+def respond(site,name):
+  """
+  Response for a resource from the cache, building it if the site
+  changed since it was cached. None if there is no such resource.
+  Without a watcher the site is refreshed and the resource built on
+  every request, as there is no telling whether it changed
+  """
+  with _lock:
+    if not site.watching:
+      site.refresh()
+    key = (name,site.generation)
+    response = _responses.get(key) if site.watching else None
+    if response is None:
+      build(site,name)
+      path = os.path.join(DEFAULT_PREVIEW_DIR,name)
+      if not os.path.exists(path):
+        return None
+      f = open(path,'rb')
+      try:
+        response = Response(name,f.read())
+      finally:
+        f.close()
+      if site.watching:
+        _responses.put(key,response)
+    return response
+
 def wsgifunc(site,environ, start_response):
-    block_size = 4096
     name = environ['PATH_INFO'][1:]
     print "GET "+name
     if name == '' or name[-1] == '/':
       name += 'index.html'
-    (p,ext) = os.path.splitext(name)
-    build(site,name)
-    path = os.path.join(DEFAULT_PREVIEW_DIR,name)
-    if os.path.exists(path):
-      status = '200 OK'
-      # TODO: don't fail if we don't know content type!
-      response_headers = [('Content-type',mimetypes.types_map[ext])]
-      start_response(status, response_headers)
-      file = open(path,'rb')
-      # http://www.python.org/dev/peps/pep-0333/#optional-platform-specific-file-handling
-      if 'wsgi.file_wrapper' in environ:
-          return environ['wsgi.file_wrapper'](file, block_size)
-      else:
-          return iter(lambda: file.read(block_size), '')
-    else:
+    response = respond(site,name)
+    if response is None:
       # What is there is notfound page?
       status = '404 Not Found'
       start_response(status, [])
       return ["Not Found"]
+    gzipped = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING','')
+    etag = response.etag(gzipped)
+    headers = [('ETag',etag),
+      ('Cache-Control','no-cache'),
+      ('Vary','Accept-Encoding')]
+    if etag in environ.get('HTTP_IF_NONE_MATCH',''):
+      start_response('304 Not Modified', headers)
+      return []
+    body = response.body
+    if gzipped:
+      body = response.gzipped()
+      headers.append(('Content-Encoding','gzip'))
+    headers.append(('Content-type',response.content_type))
+    headers.append(('Content-Length',str(len(body))))
+    start_response('200 OK', headers)
+    return [body]
       
 def load_hook(url,site,event):
   " invoked after site load"
@@ -68,6 +144,11 @@ def run(site,host,port):
   url = "http://%s:%i" % (host,port)
   site.hooks.append(partial(load_hook,url))
   mkdir(DEFAULT_PREVIEW_DIR)
+  # keep site current in the background rather than on each request
+  w = watcher('.',partial(sync,site),exclude=[DEFAULT_OUTPUT_DIR])
+  site.watching = True
+  site.refresh()
+  w.start()
   # TODO: we want to set the domain/root properties and 
   # have them be retained across config changes!
   print "Starting web server at %s" % url
@@ -0,0 +1,224 @@
+"""
+Benchmarks of micropress against generated sites
+
+  python benchmark.py [--pages N] [--tags N] [--depth N] [--assets N]
+                      [-o results.json] [--compare previous.json]
+
+A synthetic site is generated in a temporary directory and the
+scenarios are run against it in order, each in a fresh process (so
+that peak memory is that of the scenario alone):
+
+  cold - load the site and brew it from scratch
+  warm - brew again with nothing changed
+  edit - brew after changing the body of one page
+  query - render every page with a template listing pages by tag
+  preview - latency of preview server requests, first and cached
+
+Wall time and peak memory (ru_maxrss) of each scenario are written as
+JSON, which --compare reports against a previous run.
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+SCENARIOS = ['cold','warm','edit','query','preview']
+
+WORDS = """lorem ipsum dolor sit amet consectetur adipiscing elit cras est sed
+vestibulum feugiat erat mauris lacinia lectus morbi vitae lacus nisl fringilla
+condimentum maecenas sapien orci quis dignissim tincidunt""".split()
+
+def generate(dir,pages=500,tags=20,depth=3,assets=50,seed=1):
+  "Generate a site in dir"
+  rnd = random.Random(seed)
+  for d in ('pages','templates','css','js','resources/images','include'):
+    os.makedirs(os.path.join(dir,d))
+  def write(path,text):
+    f = open(os.path.join(dir,path),'w')
+    try:
+      f.write(text)
+    finally:
+      f.close()
+  write('site.yaml',"""encoding: utf8
+domain: http://localhost:8080
+root: /
+extensions:
+  - micropress.sitemap
+  - micropress.rss
+""")
+  # a chain of depth templates, each extending the previous one
+  write('templates/level0.tmpl',"""<!DOCTYPE html>
+<html><head><title>{{page.title}}</title>{{site.ext.feed_link(site)}}</head>
+<body>{% block body %}{{content}}{% endblock %}</body></html>
+""")
+  for n in range(1,depth):
+    write('templates/level%i.tmpl' % n,"""{%% extends 'level%i.tmpl' %%}
+{%% block body %%}<div class="level%i">{{ super() }}</div>{%% endblock %%}
+""" % (n-1,n))
+  write('templates/default.tmpl',"""{%% extends 'level%i.tmpl' %%}
+""" % (depth-1))
+  write('templates/listing.tmpl',"""{% extends 'default.tmpl' %}
+{% block body %}{{ super() }}
+{% for tag in page.tags %}<h2>{{tag}}</h2><ul>
+{% for p in site.querypages(tag=tag,maxitems=20,order='date_created') %}
+<li><a href="{{p.href()}}">{{p.title}}</a></li>{% endfor %}</ul>
+{% endfor %}
+<ul>{% for p in site.querypages(order='title',maxitems=10) %}
+<li>{{p.title}}</li>{% endfor %}</ul>
+{% endblock %}
+""")
+  tagnames = ['tag%i' % n for n in range(tags)]
+  for n in range(pages):
+    paragraphs = ["\n".join(" ".join(rnd.choice(WORDS) for w in range(12))
+      for l in range(rnd.randint(2,6))) for p in range(rnd.randint(2,8))]
+    write('pages/page%05i.markdown' % n,"""title: Page %i
+tags: %s
+category: cat%i
+date-created: %02i/%02i/2011
+
+# Page %i
+
+%s
+""" % (n,", ".join(rnd.sample(tagnames,min(3,tags))),n % 5,
+      n % 12+1,n % 28+1,n,"\n\n".join(paragraphs)))
+  for n in range(assets):
+    write('css/style%i.css' % n,"body .c%i { margin: %ipx; }\n" % (n,n))
+    write('js/script%i.js' % n,"var x%i = %i;\n" % (n,n))
+    write('resources/images/image%i.png' % n,os.urandom(rnd.randint(1024,65536)))
+
+def _site():
+  from micropress import Site, SITE_CONFIG_PATH
+  return Site(SITE_CONFIG_PATH)
+
+def _brew():
+  from micropress import DEFAULT_OUTPUT_DIR
+  _site().brew(DEFAULT_OUTPUT_DIR)
+  return {}
+
+def run_cold():
+  return _brew()
+
+def run_warm():
+  return _brew()
+
+def run_edit():
+  f = open('pages/page00000.markdown','a')
+  try:
+    f.write("\nEdited at %f\n" % time.time())
+  finally:
+    f.close()
+  return _brew()
+
+def run_query():
+  site = _site()
+  pages = site.querypages()
+  for p in pages:
+    p.template = 'listing'
+    p.render()
+  return dict(pages=len(pages))
+
+def run_preview():
+  import micropress.web as web
+  from micropress.util import mkdir
+  from micropress import DEFAULT_PREVIEW_DIR
+  site = _site()
+  site.domain = 'http://localhost:8080'
+  site.preview_mode = True
+  site.watching = True
+  mkdir(DEFAULT_PREVIEW_DIR)
+  names = [p.name+'.html' for p in site.querypages(maxitems=50)]
+  def request(name):
+    start = time.time()
+    body = ''.join(web.wsgifunc(site,dict(PATH_INFO='/'+name),
+      lambda status,headers: None))
+    return (time.time()-start)*1000
+  first = [request(n) for n in names]
+  cached = [request(n) for n in names]
+  return dict(requests=len(names),
+    first_ms=sum(first)/len(first),first_max_ms=max(first),
+    cached_ms=sum(cached)/len(cached),cached_max_ms=max(cached))
+
+def scenario(name,sitedir):
+  "Run a scenario in this process, returning its measurements"
+  sys.path.insert(0,ROOT)
+  os.chdir(sitedir)
+  # micropress reports progress on stdout
+  devnull = open(os.devnull,'w')
+  stdout = sys.stdout
+  sys.stdout = devnull
+  try:
+    start = time.time()
+    result = globals()['run_'+name]()
+    result['wall'] = time.time()-start
+  finally:
+    sys.stdout = stdout
+  result['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return result
+
+def run(options):
+  sitedir = tempfile.mkdtemp(prefix='micropress-bench-')
+  try:
+    generate(sitedir,options.pages,options.tags,options.depth,options.assets)
+    results = {}
+    for name in options.scenarios:
+      out = subprocess.check_output([sys.executable,os.path.abspath(__file__),
+        '--scenario',name,'--site',sitedir])
+      results[name] = json.loads(out)
+      print "%-8s %8.3fs %8i KB" % (name,results[name]['wall'],
+        results[name]['maxrss_kb'])
+  finally:
+    shutil.rmtree(sitedir)
+  return dict(
+    params=dict(pages=options.pages,tags=options.tags,depth=options.depth,
+      assets=options.assets),
+    python=sys.version.split()[0],
+    time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+    results=results)
+
+def compare(previous,current):
+  "Print changes of wall time and peak memory between two runs"
+  if previous.get('params') != current['params']:
+    print "warning: sites generated with different parameters"
+  for (name,result) in sorted(current['results'].items()):
+    before = previous['results'].get(name)
+    if before is None:
+      continue
+    print "%-8s wall %+6.1f%%  maxrss %+6.1f%%" % (name,
+      100.0*(result['wall']-before['wall'])/max(before['wall'],1e-6),
+      100.0*(result['maxrss_kb']-before['maxrss_kb'])/max(before['maxrss_kb'],1))
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark micropress")
+  parser.add_argument('--pages',type=int,default=500)
+  parser.add_argument('--tags',type=int,default=20)
+  parser.add_argument('--depth',type=int,default=3,help='template depth')
+  parser.add_argument('--assets',type=int,default=50,
+    help='number of css, js and image files each')
+  parser.add_argument('--only',dest='scenarios',action='append',
+    choices=SCENARIOS,help='run only these scenarios')
+  parser.add_argument('-o',dest='output',help='write results as JSON')
+  parser.add_argument('--compare',help='JSON results of a previous run')
+  parser.add_argument('--scenario',help=argparse.SUPPRESS)
+  parser.add_argument('--site',help=argparse.SUPPRESS)
+  options = parser.parse_args(argv[1:])
+  if options.scenario:
+    print json.dumps(scenario(options.scenario,options.site))
+    return
+  options.scenarios = options.scenarios or SCENARIOS
+  results = run(options)
+  if options.output:
+    json.dump(results,open(options.output,'w'),indent=1,sort_keys=True)
+  if options.compare:
+    compare(json.load(open(options.compare)),results)
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -3,7 +3,22 @@
 from micropress import Site,Page
 import unittest
 import datetime
-from micropress import DEFAULT_OUTPUT_DIR
+import os.path
+import re
+import tempfile
+import gzip
+import shutil
+import multiprocessing
+from micropress import DEFAULT_OUTPUT_DIR, MANIFEST_PATH
+from micropress.manifest import BuildManifest
+from micropress.fs import snapshot
+from micropress.deps import DependencyRecorder
+from micropress import watch, util, profiling, deploy, shard, compress, cache
+
+def files(dir):
+  "Paths of the files in dir, relative to dir"
+  return [os.path.relpath(os.path.join(d,f),dir)
+    for (d,dirs,names) in os.walk(dir) for f in names]
 
 class SiteTest(unittest.TestCase):
   def setUp(self):
@@ -20,13 +35,379 @@ class SiteTest(unittest.TestCase):
     self.assertEqual(len(site.querypages()),2);
     self.assertEqual(len(site.querypages(tag='foo')),1);
     self.assertEqual(len(site.querypages(category='alt')),1);
+    self.assertEqual(len(site.querypages(tags=['foo','bar'])),1);
+    self.assertEqual(len(site.querypages(tags=['foo','baz'])),0);
+    self.assertEqual([p.name for p in site.querypages(order='title')],
+      ['lorem','sub/subpage'])
+    self.assertEqual([p.name for p in site.querypages(order='title',offset=1)],
+      ['sub/subpage'])
+    self.assertEqual([p.name for p in site.querypages(order='title',maxitems=1)],
+      ['lorem'])
+    self.assertEqual(site.querypages(order='title',maxitems=0),[])
+    self.assertEqual(site.querypages(maxitems=0,offset=1),[])
+    
+  def testPageIndex(self):
+    site = self.site
+    p = site.page('lorem')
+    site.index.remove('lorem')
+    self.assertEqual(len(site.querypages(tag='foo')),0);
+    self.assertEqual(site.index.tags(),[])
+    site.index.add(p)
+    self.assertEqual(site.index.tags(),['bar','foo'])
+    self.assertEqual(site.index.categories(),['alt'])
+    # removed by the tags it was indexed with, not its current ones
+    p.tags = ['other']
+    site.index.remove('lorem')
+    self.assertEqual(site.index.tags(),[])
+    site.index.add(p)
+
+  def testPageIndexDates(self):
+    class BadDate(object):
+      name = 'bad'
+      tags = ['foo']
+      category = None
+      title = 'Bad'
+      def date_created(self):
+        raise ValueError("bad date")
+    site = self.site
+    site.index.add(BadDate())
+    self.assertEqual([p.name for p in site.querypages(tag='foo',order='title')],
+      ['bad','lorem'])
+    self.assertRaises(ValueError,site.querypages,order='date_created')
+    site.index.remove('bad')
+    self.assertEqual(len(site.querypages(order='date_created')),2)
     
   def testBrew(self):
     self.site.brew(DEFAULT_OUTPUT_DIR)
+
+  def testBrewParallel(self):
+    dirs = [tempfile.mkdtemp() for i in range(2)]
+    try:
+      self.site.brew(dirs[0])
+      self.site.brew(dirs[1],jobs=2)
+      names = sorted(files(dirs[0]))
+      self.assertEqual(sorted(files(dirs[1])),names)
+      # the 404 page shows the repr of the site
+      names.remove('errors/404.html')
+      for name in names:
+        self.assertEqual(open(os.path.join(dirs[1],name)).read(),
+          open(os.path.join(dirs[0],name)).read(),name)
+    finally:
+      for d in dirs:
+        shutil.rmtree(d)
+    
+  def testParallelBatches(self):
+    from micropress import parallel
+    (first,second) = self.site.processors[:2]
+    resources = [('r%i' % i,first) for i in range(10)]+[('s',second)]
+    tasks = parallel._batches(self.site,resources,'out',1)
+    self.assertEqual(tasks,[(0,['r0','r4','r8'],'out'),(0,['r1','r5','r9'],'out'),
+      (0,['r2','r6'],'out'),(0,['r3','r7'],'out'),(1,['s'],'out')])
+
+  def testResourceIndex(self):
+    site = self.site
+    self.assertEqual(site.resource_processor('css/less.css').__class__.__name__,
+      'LessProcessor')
+    self.assertTrue(site.resource_processor('images/footer.jpg') is site.processors[0])
+    self.assertTrue(site.resource_processor('css/missing.css') is None)
+    self.assertEqual(site.resource_href('feed.xml'),'/feed.xml')
+    self.assertEqual(site.resource_collisions,[])
+    
+  def testManifest(self):
+    site = self.site
+    site.brew(DEFAULT_OUTPUT_DIR)
+    self.assertTrue(site.manifest is None)
+    manifest = BuildManifest(MANIFEST_PATH)
+    f = os.path.join(DEFAULT_OUTPUT_DIR,'lorem.html')
+    self.assertTrue(manifest.isfresh(f,None,site.buildkey,site.values))
+    self.assertFalse(manifest.isfresh(f,None,'other-key'))
+    
+  def testTemplateDependencies(self):
+    site = self.site
+    self.assertEqual(site.template_dependencies('alternate'),
+      ['templates/alternate.tmpl','templates/default.tmpl',
+       'templates/utils.tmpl'])
+    site.brew(DEFAULT_OUTPUT_DIR)
+    entry = BuildManifest(MANIFEST_PATH).get(
+      os.path.join(DEFAULT_OUTPUT_DIR,'lorem.html'))
+    self.assertTrue('templates/alternate.tmpl' not in entry['inputs'])
+    self.assertTrue('include/include-me.txt' in entry['inputs'])
+    
+  def testPageSources(self):
+    # a page showing the content of others depends on their sources
+    site = self.site
+    recorder = site.recorder = DependencyRecorder()
+    try:
+      site.page('lorem').content()
+      site.page('sub/subpage').body
+    finally:
+      site.recorder = None
+    self.assertEqual(sorted(recorder.files),
+      ['pages/lorem.markdown','pages/sub/subpage.markdown'])
+
+  def testBundle(self):
+    site = self.site
+    href = site.resource_href('css/site.css')
+    self.assertTrue(re.match(r'^/css/site\.[0-9a-f]{10}\.css$',href),href)
+    outdir = tempfile.mkdtemp()
+    try:
+      site.brew(outdir)
+      css = open(os.path.join(outdir,href[1:])).read()
+      self.assertTrue(css.startswith('h1{font-size: 125%}'),css)
+      self.assertTrue(os.path.exists(os.path.join(outdir,
+        site.resource_href('js/site.js')[1:])))
+      self.assertTrue(href in open(os.path.join(outdir,'lorem.html')).read())
+      mtime = os.path.getmtime(os.path.join(outdir,href[1:]))
+      site.brew(outdir)
+      self.assertEqual(os.path.getmtime(os.path.join(outdir,href[1:])),mtime)
+      # pages are rebuilt to link a bundle whose members changed
+      css = open('css/sample.css').read()
+      try:
+        open('css/sample.css','a').write('\nh2 { color: red; }')
+        site.brew(outdir)
+        changed = site.resource_href('css/site.css')
+        self.assertNotEqual(changed,href)
+        self.assertTrue(changed in open(os.path.join(outdir,'lorem.html')).read())
+      finally:
+        open('css/sample.css','w').write(css)
+    finally:
+      shutil.rmtree(outdir)
+    
+  def testCompress(self):
+    site = self.site
+    site.config['compress'] = dict(brotli=False)
+    outdir = tempfile.mkdtemp()
+    pools = []
+    ThreadPool = compress.ThreadPool
+    compress.ThreadPool = lambda n: pools.append(n) or ThreadPool(n)
+    try:
+      site.brew(outdir)
+      self.assertEqual(pools,[multiprocessing.cpu_count()])
+      path = os.path.join(outdir,'lorem.html')
+      self.assertEqual(gzip.open(path+'.gz').read(),open(path).read())
+      self.assertFalse(os.path.exists(os.path.join(outdir,'images/footer.jpg.gz')))
+      mtime = os.path.getmtime(path+'.gz')
+      site.brew(outdir)
+      self.assertEqual(os.path.getmtime(path+'.gz'),mtime)
+    finally:
+      compress.ThreadPool = ThreadPool
+      shutil.rmtree(outdir)
+    
+  def testFeeds(self):
+    site = self.site
+    site.config.update({'rss-items':1,'rss-excerpt':True,'rss-tag-feeds':True,
+      'rss-category-feeds':True})
+    site.refresh_resources()
+    self.assertEqual(site.resource_href('feeds/tag/foo.xml'),'/feeds/tag/foo.xml')
+    outdir = tempfile.mkdtemp()
+    try:
+      site.brew(outdir)
+      feed = open(os.path.join(outdir,'feed.xml')).read()
+      self.assertEqual(feed.count('<item>'),1)
+      self.assertEqual(feed.count('&lt;/p&gt;'),1)
+      tagged = open(os.path.join(outdir,'feeds/tag/foo.xml')).read()
+      self.assertTrue('lorem.html' in tagged)
+      alt = open(os.path.join(outdir,'feeds/category/alt.xml')).read()
+      self.assertTrue('subpage.html' in alt and 'lorem.html' not in alt)
+      # a tag with the same slug as foo gets a feed of its own
+      p = site.page('sub/subpage')
+      p.tags = ['foo+']
+      site.index.add(p)
+      site.refresh_resources()
+      (slugs,categories) = site.resource_processor('feed.xml').slugs()
+      self.assertEqual(slugs['foo'],'foo')
+      self.assertTrue(slugs['foo+'].startswith('foo-'))
+      site.brew(outdir)
+      tagged = open(os.path.join(outdir,'feeds/tag/%s.xml' % slugs['foo+'])).read()
+      self.assertTrue('subpage.html' in tagged and 'lorem.html' not in tagged)
+    finally:
+      shutil.rmtree(outdir)
+
+  def testSitemapShards(self):
+    site = self.site
+    site.config.update({'sitemap-shard-size':2,'sitemap-resources':['.ico']})
+    site.refresh_resources()
+    self.assertTrue(site.resource_processor('sitemap-2.xml') is not None)
+    outdir = tempfile.mkdtemp()
+    try:
+      site.brew(outdir)
+      index = open(os.path.join(outdir,'sitemap.xml')).read()
+      self.assertTrue('<sitemapindex' in index and 'sitemap-2.xml' in index)
+      first = open(os.path.join(outdir,'sitemap-1.xml')).read()
+      self.assertEqual(first.count('<url>'),2)
+      self.assertTrue('favicon.ico' in open(os.path.join(outdir,'sitemap-2.xml')).read())
+      mtime = os.path.getmtime(os.path.join(outdir,'sitemap-1.xml'))
+      site.brew(outdir)
+      self.assertEqual(os.path.getmtime(os.path.join(outdir,'sitemap-1.xml')),mtime)
+    finally:
+      shutil.rmtree(outdir)
+
+  def testListings(self):
+    site = self.site
+    site.config['listing-size'] = 1
+    site.refresh_resources()
+    month = site.page('lorem').date_created().strftime('archive/%Y/%m')
+    self.assertTrue(site.resource_processor(month+'/2.html') is not None)
+    outdir = tempfile.mkdtemp()
+    try:
+      site.brew(outdir)
+      html = open(os.path.join(outdir,'tag/foo/index.html')).read()
+      self.assertTrue('lorem.html' in html and 'older' not in html)
+      first = open(os.path.join(outdir,month,'index.html')).read()
+      self.assertTrue('/%s/2.html' % month in first)
+      entry = BuildManifest(MANIFEST_PATH).get(
+        os.path.join(outdir,'tag/foo/index.html'))
+      self.assertTrue('include/include-me.txt' in entry['inputs'])
+      mtimes = [os.path.getmtime(os.path.join(outdir,rsc))
+        for rsc in ('tag/foo/index.html','category/alt/index.html')]
+      # only listings of a page whose header changed are rebuilt
+      site.page('sub/subpage').header['changed'] = 'yes'
+      site.brew(outdir)
+      self.assertEqual(os.path.getmtime(os.path.join(outdir,'tag/foo/index.html')),mtimes[0])
+      self.assertNotEqual(os.path.getmtime(os.path.join(outdir,'category/alt/index.html')),mtimes[1])
+    finally:
+      shutil.rmtree(outdir)
+
+  def testChanges(self):
+    site = self.site
+    outdir = tempfile.mkdtemp()
+    staging = tempfile.mkdtemp()
+    try:
+      site.brew(outdir)
+      self.assertTrue('lorem.html' in site.changes['added'])
+      self.assertTrue(sum(util.publish_stats.values()) > 0)
+      # an output of a page since removed
+      orphan = os.path.join(outdir,'old/page.html')
+      os.mkdir(os.path.dirname(orphan))
+      open(orphan,'w').write('old')
+      manifest = BuildManifest(MANIFEST_PATH)
+      manifest.record(orphan,[],site.buildkey)
+      manifest.save()
+      site.brew(outdir)
+      self.assertEqual(site.changes['added'],{})
+      # figures are those of this brew alone
+      self.assertEqual(util.publish_stats,dict(copied=0,linked=0))
+      self.assertFalse('lorem.html' in site.changes['modified'])
+      self.assertEqual(site.changes['deleted'],['old/page.html'])
+      self.assertFalse(os.path.exists(os.path.dirname(orphan)))
+      deploy.export(outdir,dict(added={'lorem.html':''},modified={},deleted=[]),staging)
+      self.assertEqual(sorted(os.listdir(staging)),['changes.json','lorem.html'])
+    finally:
+      shutil.rmtree(outdir)
+      shutil.rmtree(staging)
+
+  def testShards(self):
+    site = self.site
+    self.assertEqual(shard.assign(['a','b','c','d'],dict(a=3,b=1,c=1,d=1),2),
+      dict(a=1,b=2,c=2,d=2))
+    self.assertEqual(shard.parse('2/3'),(2,3))
+    self.assertRaises(ValueError,shard.parse,'4/3')
+    dirs = [tempfile.mkdtemp() for i in range(3)]
+    outdir = dirs[-1]
+    try:
+      for i in (1,2):
+        site.brew(dirs[i-1],shard=(i,2))
+      shares = [set(files(d))-set([shard.SHARD_RECORD]) for d in dirs[:2]]
+      self.assertFalse(shares[0] & shares[1])
+      self.assertTrue('lorem.html' in shares[0] | shares[1])
+      self.assertFalse('sitemap.xml' in shares[0] | shares[1])
+      site.merge(outdir,dirs[:2])
+      self.assertEqual(set(files(outdir)),
+        set(os.path.relpath(f,outdir) for f in site.outputs(outdir)))
+      # the merged site is up to date
+      site.brew(outdir)
+      self.assertFalse([n for n in site.costs if n[:-5] in site.pages])
+    finally:
+      for d in dirs:
+        shutil.rmtree(d)
+
+  def testCompileCache(self):
+    site = self.site
+    proc = site.resource_processor('css/less.css')
+    self.assertEqual(proc.dependencies('css/less.less'),['css/less.less'])
+    key = proc.cachekey('css/less.less')
+    outdir = tempfile.mkdtemp()
+    try:
+      site.brew(outdir)
+      self.assertEqual(site.compile_cache.get(key),
+        open(os.path.join(outdir,'css/less.css'),'rb').read())
+    finally:
+      shutil.rmtree(outdir)
+    
+  def testProfile(self):
+    profiler = profiling.enable()
+    outdir = tempfile.mkdtemp()
+    try:
+      Site('site.yaml').brew(outdir)
+      cats = set(e['cat'] for e in profiler.events)
+      for cat in ('extension','processor','page','template','markdown'):
+        self.assertTrue(cat in cats)
+      self.assertEqual(profiler.totals('page')[0][1],1)
+      self.assertTrue('slowest pages:' in profiler.summary(1))
+    finally:
+      profiling.disable()
+      shutil.rmtree(outdir)
+
+  def testTemplateCache(self):
+    site = self.site
+    self.assertEqual(sorted(site.precompile()),
+      ['404.tmpl','alternate.tmpl','default.tmpl','listing.tmpl','utils.tmpl'])
+    self.assertTrue(len(os.listdir('.micropress/templates')) >= 4)
+    self.assertFalse(site.load_template('default').environment.auto_reload)
+    site.preview_mode = True
+    self.assertTrue(site.load_template('default').environment.auto_reload)
+
+  def testReload(self):
+    # a site loaded again sees pages changed in the same process
+    path = os.path.join(DEFAULT_OUTPUT_DIR,'lorem.html')
+    source = open('pages/lorem.markdown').read()
+    try:
+      self.site.brew(DEFAULT_OUTPUT_DIR)
+      open('pages/lorem.markdown','a').write('\nReloaded text\n')
+      Site('site.yaml').brew(DEFAULT_OUTPUT_DIR)
+      self.assertTrue('Reloaded text' in open(path).read())
+    finally:
+      open('pages/lorem.markdown','w').write(source)
+
+  def testSnapshot(self):
+    snapshot.invalidate()
+    calls = snapshot.syscalls
+    self.assertTrue(snapshot.exists('site.yaml'))
+    snapshot.getmtime('site.yaml')
+    self.assertEqual(snapshot.syscalls,calls+1)
+    self.assertEqual(snapshot.listdir('pages'),(['sub'],['lorem.markdown']))
     
   def testGetContents(self):
     self.assertEqual(self.site.getcontents('include/include-me.txt'),"Hello World!")
     
+  def testContentCache(self):
+    site = self.site
+    p = site.page('lorem')
+    html = p.content()
+    self.assertTrue(site.content_cache.key(p.body) in site.content_cache.memory)
+    site.content_cache.memory.clear()
+    self.assertEqual(p.content(),html)
+    
+  def testDiskCache(self):
+    dir = tempfile.mkdtemp()
+    rename = os.rename
+    try:
+      disk = cache.DiskCache(dir)
+      disk.put('abcd','one')
+      self.assertEqual(disk.get('abcd'),'one')
+      # another machine stores the same key first
+      def race(tmp,path):
+        open(path,'w').write('two')
+        raise OSError(17,'File exists')
+      os.rename = race
+      disk.put('abcd','one')
+      os.rename = rename
+      self.assertEqual(disk.get('abcd'),'two')
+      self.assertEqual(files(dir),['ab/abcd'])
+    finally:
+      os.rename = rename
+      shutil.rmtree(dir)
+
 class PageTest(unittest.TestCase):
   def setUp(self):
     self.site = Site('site.yaml')
@@ -46,5 +427,190 @@ class PageTest(unittest.TestCase):
     
 #    self.assertTrue(isinstance(p.date_created(),types.datetime))
 
+  def testLazyBodies(self):
+    site = self.site
+    site.bodies.maxitems = 1
+    p = site.page('lorem')
+    self.assertFalse(p.path in site.bodies)
+    self.assertRaises(AttributeError,setattr,p,'extra',1)
+    self.assertTrue(p.tags[0] is site._strings['foo'])
+    html = p.content()
+    self.assertTrue(p.path in site.bodies)
+    site.page('sub/subpage').content()
+    self.assertEqual(len(site.bodies),1)
+    self.assertFalse(p.path in site.bodies)
+    self.assertEqual(p.content(),html)
+    # converted content is found without reading the body again
+    self.assertFalse(p.path in site.bodies)
+
+class ToolTest(unittest.TestCase):
+  def testTimeout(self):
+    self.assertRaises(Exception,util.exectool,'sleep','5',timeout=0.2)
+    # a program killed by a signal is a failure, not a timeout
+    try:
+      util.exectool('sh','-c','kill -9 $$',timeout=30)
+      self.fail()
+    except Exception, e:
+      self.assertTrue('err code' in str(e),str(e))
+
+  def testExecTools(self):
+    util.exectools([('true',)]*4,jobs=2)
+    self.assertRaises(Exception,util.exectools,[('true',),('false',)],jobs=2)
+
+  def testPublish(self):
+    dir = tempfile.mkdtemp()
+    try:
+      src = os.path.join(dir,'src')
+      open(src,'wb').write('x'*1000)
+      for strategy in util.PUBLISH_STRATEGIES:
+        dest = os.path.join(dir,strategy)
+        open(dest,'wb').write('old')
+        util.publish(src,dest,strategy)
+        self.assertEqual(open(dest,'rb').read(),'x'*1000)
+      self.assertEqual(os.stat(src).st_nlink,2)
+      # republishing replaces rather than writing through the link
+      open(os.path.join(dir,'new'),'wb').write('y')
+      util.publish(os.path.join(dir,'new'),os.path.join(dir,'hardlink'),'copy')
+      self.assertEqual(open(src,'rb').read(),'x'*1000)
+      self.assertRaises(Exception,util.publish,src,os.path.join(dir,'x'),'teleport')
+    finally:
+      shutil.rmtree(dir)
+
+class WatchTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.dir,'sub'))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def checkWatcher(self,w):
+    path = os.path.join(self.dir,'sub','a.txt')
+    open(path,'w').write('a')
+    self.assertTrue(path in w.poll(1.0))
+    os.remove(path)
+    self.assertTrue(path in w.poll(1.0))
+
+  def testPolling(self):
+    self.checkWatcher(watch.PollingWatcher(self.dir,None,interval=0))
+
+  def testWatcher(self):
+    self.checkWatcher(watch.watcher(self.dir,None))
+
+class DataTest(unittest.TestCase):
+  def setUp(self):
+    import BaseHTTPServer, threading
+    requests = self.requests = []
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+        requests.append(self.headers.getheader('If-None-Match'))
+        if self.headers.getheader('If-None-Match') == '"v1"':
+          self.send_response(304)
+          self.end_headers()
+          return
+        self.send_response(200)
+        self.send_header('ETag','"v1"')
+        self.end_headers()
+        self.wfile.write('{"name": "remote"}')
+      def log_message(self,*args):
+        pass
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1',0),Handler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.url = 'http://127.0.0.1:%i/data.json' % self.server.server_address[1]
+    self.site = Site('site.yaml')
+    self.site.load_extension('micropress.data.json')
+    self.loader = self.site.ext['json'].im_self
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testRevalidate(self):
+    site = self.site
+    site.config['data-ttl'] = 0
+    self.assertEqual(site.ext['json'](self.url),{'name':'remote'})
+    self.assertEqual(site.ext['json'](self.url),{'name':'remote'})
+    self.assertEqual(self.requests,[None])
+    site.generation += 1
+    self.assertEqual(site.ext['json'](self.url),{'name':'remote'})
+    self.assertEqual(self.requests,[None,'"v1"'])
+
+  def testPrefetch(self):
+    self.loader.prefetch([self.url])
+    self.assertTrue('data:'+self.url in self.site.values)
+    # within the ttl the disk cache is used
+    loader = self.loader.__class__(self.site)
+    loader.load(self.url)
+    self.assertEqual(len(self.requests),1)
+
+  def testFile(self):
+    dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(dir,'data.json')
+      open(path,'w').write('[1]')
+      self.assertEqual(self.site.ext['json'](path),[1])
+      open(path,'w').write('[1, 2]')
+      os.utime(path,(0,0))
+      snapshot.forget(path)
+      self.assertEqual(self.site.ext['json'](path),[1,2])
+    finally:
+      shutil.rmtree(dir)
+
+class WebTest(unittest.TestCase):
+  def setUp(self):
+    import micropress.web
+    self.web = micropress.web
+    self.site = Site('site.yaml')
+
+  def request(self,name,**environ):
+    environ['PATH_INFO'] = '/'+name
+    response = {}
+    def start_response(status,headers):
+      response['status'] = status
+      response['headers'] = dict(headers)
+    body = ''.join(self.web.wsgifunc(self.site,environ,start_response))
+    return (response['status'],response['headers'],body)
+
+  def testCaching(self):
+    (status,headers,body) = self.request('lorem.html')
+    self.assertEqual(status,'200 OK')
+    self.assertEqual(headers['Content-type'],'text/html')
+    etag = headers['ETag']
+    (status,headers,body) = self.request('lorem.html',HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(status,'304 Not Modified')
+    (status,headers,gz) = self.request('lorem.html',HTTP_ACCEPT_ENCODING='gzip')
+    self.assertEqual(headers['Content-Encoding'],'gzip')
+    self.assertNotEqual(headers['ETag'],etag)
+    (status,headers,body) = self.request('lorem.html',HTTP_IF_NONE_MATCH=etag,
+      HTTP_ACCEPT_ENCODING='gzip')
+    self.assertEqual(status,'200 OK')
+    (status,headers,body) = self.request('missing.html')
+    self.assertEqual(status,'404 Not Found')
+
+  def testResponseCache(self):
+    built = []
+    build = self.web.build
+    def counting(site,name):
+      built.append(name)
+      build(site,name)
+    self.web.build = counting
+    try:
+      self.site.watching = True
+      self.site.refresh()
+      first = self.request('lorem.html')
+      self.assertEqual(self.request('lorem.html'),first)
+      self.assertEqual(built,['lorem.html'])
+      self.site.sync(['pages/lorem.markdown'])
+      self.request('lorem.html')
+      self.assertEqual(built,['lorem.html','lorem.html'])
+    finally:
+      self.web.build = build
+
+  def testContentType(self):
+    self.assertEqual(self.web.content_type('css/sample.css'),'text/css')
+    self.assertEqual(self.web.content_type('foo.unknown'),'application/octet-stream')
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file